@@ -1,8 +1,11 @@
 from flask import send_file, request, Blueprint, session, jsonify
 from users import user_manager, watch_manager
 from index.base import DB
+from index.log import LOG
 from soc import soc
 import json
+import os
+import time
 from natsort import natsorted
 
 apibp = Blueprint('apibp', __name__)
@@ -37,7 +40,7 @@ def play():
     if not user: 
         return jsonify(RESPONSE.unauthorized)
 
-    media = DB.get_media_by_id(int(db_id))
+    media = DB.get_media_ref(int(db_id))
     if not media: 
         return jsonify(RESPONSE.not_found)
 
@@ -74,17 +77,70 @@ def download_media():
     season = str(season)
     episode = str(episode)
 
-    data = DB.get_media_by_id(db_id)
+    data = DB.get_media_ref(db_id)
     if not data:
         return jsonify(RESPONSE.not_found)
 
     if season in data.file_map:
         if episode in data.file_map[season]:
-            return send_file(
-                data.file_map[season][episode], as_attachment=True)
+            path = data.file_map[season][episode]
+            if not os.path.isfile(path):
+                return jsonify(RESPONSE.not_found)
+            return stream_file(path)
 
     return jsonify(RESPONSE.not_found)
 
+class Transfer:
+    """
+    Transfer wraps a file response body and logs the bytes actually sent
+    and the throughput once the server closes it.
+    """
+
+    def __init__(self, body, name: str, status: int, byte_range: str) -> None:
+        self.body = body
+        self.name = name
+        self.status = status
+        self.byte_range = byte_range
+        self.sent = 0
+        self.start = time.time()
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if hasattr(self.body, "close"):
+            self.body.close()
+        elapsed = max(time.time() - self.start, 1e-6)
+        LOG.verbose(
+            f"Streamed {self.name} [{self.status} {self.byte_range}] "
+            f"{self.sent / 1048576:.1f} MB in {elapsed:.2f}s ({self.sent / 1048576 / elapsed:.1f} MB/s)")
+
+def is_server_file_wrapper(response) -> bool:
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if not file_wrapper:
+        return False
+    if isinstance(file_wrapper, type):
+        return isinstance(response.response, file_wrapper)
+    # uWSGI hands out a function, send_file uses it for every full response
+    # while ranges are still sliced in Python.
+    return response.status_code == 200
+
+def stream_file(path: str):
+    # conditional=True answers Range with 206 / 416 and If-None-Match with 304.
+    response = send_file(path, as_attachment=True, conditional=True, etag=True, max_age=0)
+    response.headers["Accept-Ranges"] = "bytes"
+
+    # A server supplied wsgi.file_wrapper (or X-Sendfile) sends the file without
+    # copying it through Python, so it is left untouched and not measured.
+    if response.status_code in (200, 206) and not response.headers.get("X-Sendfile") and not (
+            is_server_file_wrapper(response)):
+        response.response = Transfer(
+            response.response, os.path.basename(path), response.status_code,
+            request.headers.get("Range", "full"))
+    return response
+
 @apibp.route("/set-watched", methods=["GET"])
 def set_watched():
     db_id = request.args.get("id")
@@ -105,7 +161,7 @@ def set_watched():
     user = user_manager.get_json_api(api_key)
     if not user:
         return jsonify(RESPONSE.unauthorized)
-    data = DB.get_media_by_id(db_id)
+    data = DB.get_media_ref(db_id)
     if not data:
         return jsonify(RESPONSE.not_found)
 
@@ -133,7 +189,7 @@ def set_playback():
     user = user_manager.get_json_api(api_key)
     if not user: 
         return jsonify(RESPONSE.unauthorized)
-    data = DB.get_media_by_id(db_id)
+    data = DB.get_media_ref(db_id)
     if not data: 
         return jsonify(RESPONSE.not_found)
 
@@ -154,7 +210,7 @@ def set_watched_web():
     if not any([db_id, season, episode]): 
         return jsonify(RESPONSE.bad_request)
 
-    data = DB.get_media_by_id(int(db_id))
+    data = DB.get_media_ref(int(db_id))
     if not data: 
         return jsonify(RESPONSE.not_found)
 
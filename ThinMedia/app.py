@@ -13,7 +13,9 @@ import hp
 
 app = Flask(__name__)
 app.secret_key = "Your-Secret-Key-Here"
+app.config["USE_X_SENDFILE"] = bool(index.indexer.manager.config.get("x_sendfile", False))
 soc.start(app)
+index.indexer.manager.jobs.notify = lambda data: soc.socket.emit("index_job", data)
 
 @soc.socket.on("join")
 def on_join(data):
@@ -27,6 +29,9 @@ def on_leave(data):
 
 app.jinja_env.globals.update(encode_string=hp.encode_string)
 app.jinja_env.globals.update(decode_string=hp.decode_string)
+app.jinja_env.globals.update(image_url=hp.image_url)
+app.jinja_env.globals.update(image_srcset=lambda path: hp.image_srcset(
+    path, index.indexer.manager.tmdb.img_widths, int(index.indexer.manager.tmdb.img_s * 16 / 9)))
 
 app.register_blueprint(homebp)
 app.register_blueprint(apibp)
@@ -0,0 +1,95 @@
+"""
+Home grid render time on a synthetic catalog, old template against cached cards.
+
+    python bench/card_bench.py --titles 10000 --page 100
+
+Runs without the app or a database, only the templates and hp helpers are
+used, so image urls point at files that do not exist.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from jinja2 import Environment, FileSystemLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from index.catalog import Catalog, Card
+import hp
+
+# The per page template /home-media-html used before cards were cached
+OLD_TEMPLATE = """{% for i in data %}
+<div class="mainmt">
+    <div class="movie">
+        <a href="/media/{{encode_string(data[i].title)}}">
+            <img src="/images/{{encode_string(data[i].img_base)}}" srcset="{{image_srcset(data[i].img_base)}}"
+                sizes="450px" loading="lazy" alt="Image not found.">
+        </a>
+    </div>
+    <h3 class="mt">{{data[i].title}}</h3>
+</div>
+{%endfor%}"""
+
+WORDS = ["the", "star", "night", "house", "dragon", "last", "city", "blue", "dark", "river",
+    "king", "office", "lost", "world", "game", "of", "shadow", "north", "wild", "code"]
+
+def make_cards(count: int, seed: int) -> list[Card]:
+    rnd = random.Random(seed)
+    cards = []
+    for i in range(count):
+        title = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))).title() + f" {i}"
+        cards.append(Card(i, title, rnd.choice(["tv", "movie"]), [], f"/data/img/{i}/backdrop.jpg"))
+    return cards
+
+def timed(func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark home grid rendering.")
+    parser.add_argument("--titles", type=int, default=10000)
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(hp.__file__), "templates")))
+    env.globals.update(
+        encode_string=hp.encode_string, image_url=hp.image_url,
+        image_srcset=lambda path: hp.image_srcset(path, [320, 640, 1280], 1280))
+    old = env.from_string(OLD_TEMPLATE)
+    card = env.get_template("media_card.html")
+
+    start = time.perf_counter()
+    cards = make_cards(args.titles, args.seed)
+    catalog = Catalog()
+    catalog.load(cards)
+    print(f"load      {args.titles} cards in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    pages = [cards[i:i + args.page] for i in range(0, len(cards), args.page)]
+    page = pages[len(pages) // 2]
+
+    old_ms = timed(lambda: old.render(data={i.title: i for i in page}), args.repeat)
+
+    def cold():
+        catalog.fragments.clear()
+        catalog.render(page, lambda i: card.render(card=i))
+    cold_ms = timed(cold, args.repeat)
+
+    catalog.render(page, lambda i: card.render(card=i))
+    warm_ms = timed(lambda: catalog.render(page, lambda i: card.render(card=i)), args.repeat)
+
+    start = time.perf_counter()
+    for i in pages:
+        catalog.render(i, lambda c: card.render(card=c))
+    walk_ms = (time.perf_counter() - start) * 1000
+
+    print(f"old       {old_ms:.3f}ms per {args.page} card page")
+    print(f"cold      {cold_ms:.3f}ms per page")
+    print(f"warm      {warm_ms:.3f}ms per page")
+    print(f"all pages {len(pages)} pages first render in {walk_ms:.1f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Seek latency and throughput of /download-media against a running server.
+
+    python bench/stream_bench.py "http://localhost:5000/download-media?id=1&season=1&episode=1"
+
+A full download measures throughput, then random Range requests measure
+the time to the first byte of a seek the way mpv issues them.
+"""
+import argparse
+import random
+import statistics
+import time
+import requests
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def full_download(session, url: str, chunk: int):
+    start = time.perf_counter()
+    size = 0
+    with session.get(url, stream=True) as r:
+        r.raise_for_status()
+        for i in r.iter_content(chunk):
+            size += len(i)
+    return size, time.perf_counter() - start
+
+def seek(session, url: str, offset: int, read: int):
+    start = time.perf_counter()
+    headers = {"Range": f"bytes={offset}-{offset + read - 1}"}
+    with session.get(url, headers=headers, stream=True) as r:
+        if r.status_code != 206:
+            raise RuntimeError(f"Expected 206 for a range request, got {r.status_code}")
+        chunks = r.iter_content(65536)
+        first = next(chunks, b"")
+        ttfb = time.perf_counter() - start
+        size = len(first) + sum(len(i) for i in chunks)
+    return ttfb, size, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /download-media seeks and throughput.")
+    parser.add_argument("url", help="full /download-media url of one episode")
+    parser.add_argument("--seeks", type=int, default=50, help="number of random range requests")
+    parser.add_argument("--read", type=int, default=1048576, help="bytes read after each seek")
+    parser.add_argument("--chunk", type=int, default=1048576, help="chunk size of the full download")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    session = requests.Session()
+    size, elapsed = full_download(session, args.url, args.chunk)
+    print(f"full      {size / 1048576:.1f} MB in {elapsed:.2f}s ({size / 1048576 / elapsed:.1f} MB/s)")
+
+    rnd = random.Random(args.seed)
+    ttfb, sent, total = [], 0, 0.0
+    for _ in range(args.seeks):
+        offset = rnd.randrange(max(1, size - args.read))
+        first, n, t = seek(session, args.url, offset, min(args.read, size))
+        ttfb.append(first * 1000)
+        sent += n
+        total += t
+
+    print(
+        f"seek      {args.seeks} ranges of {args.read / 1048576:.1f} MB, first byte "
+        f"p50 {statistics.median(ttfb):.1f}ms p95 {percentile(ttfb, 0.95):.1f}ms max {max(ttfb):.1f}ms")
+    print(f"ranges    {sent / 1048576:.1f} MB in {total:.2f}s ({sent / 1048576 / max(total, 1e-6):.1f} MB/s)")
+
+if __name__ == '__main__':
+    main()
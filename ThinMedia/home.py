@@ -1,9 +1,12 @@
-from flask import send_file, redirect, render_template, url_for, request, Blueprint, session, jsonify, Response
+from flask import send_file, redirect, render_template, url_for, request, Blueprint, session, jsonify, Response, stream_with_context, current_app
 from users import user_manager, watch_manager
 from index.base import DB
 from index.indexer import manager
 from natsort import natsorted
 import os
+import re
+import json
+import time
 import hp
 
 homebp = Blueprint('homebp', __name__)
@@ -52,34 +55,56 @@ def login():
 def home_media_html():
     if get_user():
         max_media_to_show = 100
-        data = DB.get_all()
 
         search = request.args.get("search", "") 
         genres = session.get("genres", [])
         media_type = session.get("media_type", "all")
 
-        max_pages = len(data) // max_media_to_show
+        max_pages = DB.count_media() // max_media_to_show
         session["max_pages"] = max_pages
         page = session.get("current_page", 0)
 
-        data = DB.apply_filters(data, search, genres, media_type)
-        if not search:
-            get_page = list(data.keys())[page * max_media_to_show: (page + 1) * max_media_to_show]
-            data = {i: data[i] for i in get_page}
+        if search:
+            data = DB.apply_filters(DB.get_all(), search, genres, media_type)
+        else:
+            data = DB.get_page(page, max_media_to_show, media_type, genres)
 
-        return render_template("index_media.html", data=data)
+        card = current_app.jinja_env.get_template("media_card.html")
+        return DB.render_cards(data, lambda i: card.render(card=i))
     return ""
     
 @homebp.route('/images/<dir>')
 def serve_image(dir):
     dir = hp.decode_string(str(dir))
     base = os.path.dirname(os.path.abspath(__file__))
-    return send_file(base+dir)
+    path = base + dir
+
+    # Images indexed before variants existed fall back to the full size file
+    fallback = False
+    if not os.path.exists(path):
+        variant = re.match(r"^(.*)_\d+w(\.\w+)$", path)
+        if variant:
+            path = variant.group(1) + variant.group(2)
+            fallback = True
+
+    # Only versioned urls of the exact file are safe to cache for good,
+    # anything else is revalidated against the ETag on every use.
+    if request.args.get("v") and not fallback:
+        response = send_file(path, conditional=True, etag=True, max_age=31536000)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response = send_file(path, conditional=True, etag=True, max_age=0)
+        response.cache_control.no_cache = True
+    return response
 
 @homebp.route("/unique-genres-html")
 def unique_genres_html():
     if get_user():
-        return render_template("unique_genres.html", unique_genres=DB.get_unique_genres())
+        search = request.args.get("search", "")
+        media_type = session.get("media_type", "all")
+        return render_template(
+            "unique_genres.html", unique_genres=DB.get_unique_genres(media_type, search))
     return ""
 
 @homebp.route("/set-media-type")
@@ -174,9 +199,22 @@ def settings():
         return render_template("settings.html", user=user_manager.get_json(user))
     return ""
 
-def event_stream():
-    for msg in manager.scan_and_index_current_media():
-        yield f"data: {msg}\n\n"
+def job_message(status: dict) -> str:
+    msg = f"{status['message'] or status['state'].capitalize()} ({status['done']} / {status['total']})"
+    if status["eta"] is not None:
+        msg += f" ETA: {int(status['eta'])}s"
+    return msg
+
+def event_stream(job_id: int):
+    # Tails the job, the rescan itself keeps running if the page is closed
+    while True:
+        status = manager.jobs.status(job_id)
+        if not status or status["state"] not in ["queued", "running"]:
+            break
+        yield f"data: {job_message(status)}\n\n"
+        time.sleep(1)
+    if status and status["state"] != "done":
+        yield f"data: Job {status['state']}\n\n"
     yield "data: done\n\n"
 
 @homebp.route("/index-media")
@@ -184,7 +222,15 @@ def index_media():
     user = get_user()
     if user:
         if user_manager.get_json(user)["role"] == "admin":
-            return Response(event_stream(), mimetype="text/event-stream")
+            return Response(event_stream(manager.scan_and_index_current_media()), mimetype="text/event-stream")
+    return "Insufficient permissions"
+
+@homebp.route("/cancel-index")
+def cancel_index():
+    user = get_user()
+    if user and user_manager.get_json(user)["role"] == "admin":
+        manager.jobs.cancel_active()
+        return redirect(url_for("homebp.settings"))
     return "Insufficient permissions"
 
 @homebp.route("/index-media-awc", methods=["GET", "POST"])
@@ -211,8 +257,25 @@ def index_media_awc():
             return redirect(url_for("homebp.settings"))
 
         else:
-            matches = manager.get_matches(user_manager.get_mapped(user))
-            user_manager.update_mapped(user, matches)
-            return render_template("index_media_awc.html", matches=matches)
+            return render_template("index_media_awc.html", matches=user_manager.get_mapped(user))
 
     return "Insufficient permissions"
+
+def match_stream(user: str):
+    mapped = user_manager.get_mapped(user)
+    yield f"data: {json.dumps({'msg': 'Scanning library...'})}\n\n"
+    folders = manager.find_new_folders(mapped)
+    yield f"data: {json.dumps({'msg': f'Matching {len(folders)} new folders...'})}\n\n"
+    for n, (path, match) in enumerate(manager.match_folders(folders), 1):
+        # Saved as it arrives so a disconnect keeps every row already shown
+        user_manager.add_mapped(user, path, match)
+        row = render_template("match_row.html", path=path, match=match)
+        yield f"data: {json.dumps({'row': row, 'msg': f'Matched {n} / {len(folders)}'})}\n\n"
+    yield "data: done\n\n"
+
+@homebp.route("/index-media-awc-stream")
+def index_media_awc_stream():
+    user = get_user()
+    if user and user_manager.get_json(user)["role"] == "admin":
+        return Response(stream_with_context(match_stream(user)), mimetype="text/event-stream")
+    return "Insufficient permissions"
@@ -1,4 +1,5 @@
 import codecs
+import os
 
 def encode_string(string):
     if not string:
@@ -14,3 +15,33 @@ def decode_string_list(strings: list):
     if not strings:
         return []
     return [codecs.decode(bytes(i, 'utf-8'), "hex").decode('utf-8') for i in strings]
+
+
+def variant_path(path: str, width: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}_{width}w{ext}"
+
+def image_version(path: str) -> str:
+    # The .src sidecar is rewritten with every save, including the width variants
+    full = os.path.join(os.path.dirname(os.path.abspath(__file__)), path.lstrip("/"))
+    for i in [f"{full}.src", full]:
+        try:
+            return format(int(os.stat(i).st_mtime), "x")
+        except OSError:
+            continue
+    return ""
+
+def image_url(path: str, version: str = None, encoded: str = None) -> str:
+    if not path:
+        return "/images/"
+    version = image_version(path) if version is None else version
+    encoded = encoded or encode_string(path)
+    return f"/images/{encoded}?v={version}" if version else f"/images/{encoded}"
+
+def image_srcset(path: str, widths: list, full_width: int) -> str:
+    if not path:
+        return ""
+    version = image_version(path)
+    srcset = [f"{image_url(variant_path(path, i), version)} {i}w" for i in widths if i < full_width]
+    srcset.append(f"{image_url(path, version)} {full_width}w")
+    return ", ".join(srcset)
@@ -1,10 +1,13 @@
-from sqlalchemy import Column, Integer, String, Text, JSON, create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
+from sqlalchemy import Column, Integer, String, Text, JSON, ForeignKey, Index, select
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base, relationship
 import os
 import json
 import re
 from natsort import natsorted
-from rapidfuzz import process 
+from index.catalog import Catalog, Card
+from index.search import SearchIndex
+from index.storage import create_sqlite_engine, add_columns, create_indexes
+from index.lru import LRUCache
 
 DECBASE = declarative_base()
 
@@ -18,7 +21,7 @@ class Media(DECBASE):
 
     id = Column(Integer, primary_key=True)
     media_type = Column(String, nullable=False)
-    title = Column(String, nullable=False)
+    title = Column(String, nullable=False, index=True)
 
     # Media data contains title, year, vote, vote count, info, type and genres
     media_data = Column(JSON, nullable=False)
@@ -27,43 +30,136 @@ class Media(DECBASE):
     episodes = Column(JSON, nullable=False)
 
     # Files base folder and file map for media files
-    files_base_folder = Column(String, nullable=False)
+    files_base_folder = Column(String, nullable=False, index=True)
     file_map = Column(JSON, nullable=False)
 
     # Image map contains base, header and seasons images
     img_map = Column(JSON, nullable=False)
 
+    # Card columns denormalized from media_data and img_map for the home grid
+    genres = Column(JSON, nullable=False, default=list)
+    img_base = Column(String, nullable=False, default="")
+
+    # Natural sort key of the title so ordering and paging can run in SQL
+    sort_key = Column(String, nullable=False, default="", index=True)
+
+    genre_rows = relationship("MediaGenre", cascade="all, delete-orphan")
+
+    __table_args__ = (Index("ix_media_type_sort_key", "media_type", "sort_key"),)
+
+class MediaGenre(DECBASE):
+    """
+    MediaGenre is the normalized genre membership of a media row,
+    used to filter pages by genre in SQL.
+    """
+
+    __tablename__ = 'media_genre'
+
+    id = Column(Integer, primary_key=True)
+    media_id = Column(Integer, ForeignKey('media.id'), nullable=False)
+    genre = Column(String, nullable=False)
+
+    __table_args__ = (Index("ix_media_genre_genre", "genre", "media_id"),)
+
+class MediaRef:
+    """
+    MediaRef holds what the player endpoints need from a media row.
+    """
+
+    __slots__ = ("id", "title", "episodes", "file_map")
+
+    def __init__(self, id: int, title: str, episodes: dict, file_map: dict) -> None:
+        self.id = id
+        self.title = title
+        self.episodes = episodes
+        self.file_map = file_map
+
 class Base:
     def __init__(self) -> None:
-        self.engine = create_engine(
-            'sqlite:///' + os.path.join(
+        self.engine = create_sqlite_engine(
+            os.path.join(
                 os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 
                 'data', 'media.db'))
         DECBASE.metadata.create_all(self.engine)
         self.Session = sessionmaker(bind=self.engine)
         self.sco = scoped_session(self.Session)
         self.media_type_map = {0: "all", 1: "tv", 2: "movie"}
+        self.catalog = Catalog(SearchIndex(self.normalize_title))
+        self.refs = LRUCache(max_size=4096, ttl=600)
+        self.migrate()
+
+    def migrate(self):
+        missing = add_columns(self.engine, "media", {
+            "genres": "JSON NOT NULL DEFAULT '[]'",
+            "img_base": "VARCHAR NOT NULL DEFAULT ''",
+            "sort_key": "VARCHAR NOT NULL DEFAULT ''"})
+
+        if missing:
+            with self.sco() as session:
+                for i in session.query(Media).all():
+                    self.set_card_columns(i)
+                session.commit()
+
+        create_indexes(self.engine, DECBASE.metadata)
+
+    def natural_key(self, title: str) -> str:
+        return re.sub(r'\d+', lambda m: m.group().lstrip('0').zfill(20), title)
+
+    def set_card_columns(self, media: Media):
+        media.genres = list(media.media_data.get("genres", []))
+        media.img_base = (media.img_map.get("base") or "") if media.img_map else ""
+        media.sort_key = self.natural_key(media.title)
+        media.genre_rows = [MediaGenre(genre=g) for g in set(media.genres)]
 
     def to_json(self, item: dict) -> dict:
         return json.loads(json.dumps(item))
 
+    def create_card(self, media: Media) -> Card:
+        return Card(
+            id=media.id, title=media.title, media_type=media.media_type,
+            genres=media.genres, img_base=media.img_base)
+
+    def get_cards(self) -> list[Card]:
+        with self.sco() as session:
+            rows = session.query(
+                Media.id, Media.title, Media.media_type, Media.genres, Media.img_base).all()
+            return [Card(*i) for i in rows]
+
     def get_all(self) -> dict:
+        self.catalog.ensure(self.get_cards)
+        return self.catalog.get_all()
+
+    def render_cards(self, data: dict, render_card) -> str:
+        return self.catalog.render(data.values(), render_card)
+
+    def filter_query(self, query, media_type: str, genres: list[str]):
+        if media_type != "all":
+            query = query.filter(Media.media_type == media_type)
+        if genres:
+            query = query.filter(Media.id.in_(
+                select(MediaGenre.media_id).where(MediaGenre.genre.in_(genres))))
+        return query
+
+    def get_page(self, page: int, size: int, media_type: str = "all", genres: list[str] = []) -> dict:
+        with self.sco() as session:
+            query = session.query(
+                Media.id, Media.title, Media.media_type, Media.genres, Media.img_base)
+            query = self.filter_query(query, media_type, genres)
+            rows = query.order_by(Media.sort_key).limit(size).offset(page * size).all()
+            return {i.title: Card(*i) for i in rows}
+
+    def count_media(self, media_type: str = "all", genres: list[str] = []) -> int:
         with self.sco() as session:
-            all_media = session.query(Media).all()
-            if all_media:
-                d = {i.title: i for i in all_media}
-                return {i: d[i] for i in natsorted(list(d.keys()))}
-            return {}
+            return self.filter_query(session.query(Media.id), media_type, genres).count()
 
     def get_all_sql(self) -> list[Media]:
         with self.sco() as session:
             return session.query(Media).all()
 
-    def search(self, search: str, data: dict) -> dict:
-        search = search.lower()
-        r = {k.lower(): k for k in list(data.keys())}
-        res = [r[i[0]] for i in process.extract(search, list(r.keys()), limit=20) if i[1] > 40]
-        return {i: data[i] for i in res}
+    def search(self, search: str, data: dict, limit: int = 20) -> dict:
+        self.catalog.ensure(self.get_cards)
+        res = [i for i in self.catalog.search_index.search(search, limit=None) if i in data]
+        return {i: data[i] for i in res[:limit]}
 
     def apply_filters(self, data: dict, search: str, genres: list[str], media_type: str):
         if media_type != "all":
@@ -71,15 +167,17 @@ class Base:
         if search:
             data = self.search(search, data)
         if genres:
-            data = {i: data[i] for i in data if any(g in data[i].media_data["genres"] for g in genres)}
+            titles = self.catalog.titles_with_genres(genres)
+            data = {i: data[i] for i in data if i in titles}
         return data
 
-    def get_unique_genres(self) -> list:
-        genres = set()
-        data = self.get_all_sql()
-        for i in data:
-            for g in i.media_data["genres"]: genres.add(g)
-        return natsorted(list(genres))
+    def get_unique_genres(self, media_type: str = "all", search: str = "") -> dict:
+        self.catalog.ensure(self.get_cards)
+        titles = None
+        if media_type != "all" or search:
+            titles = self.apply_filters(self.get_all(), search, [], media_type)
+        counts = self.catalog.genre_counts(titles)
+        return {i: counts[i] for i in natsorted(list(counts.keys()))}
 
     def get_media(self, title: str) -> Media:
             with self.sco() as session:
@@ -89,44 +187,103 @@ class Base:
         with self.sco() as session:
             return session.query(Media).filter_by(files_base_folder=path).first()
 
+    def get_base_folders(self) -> list[str]:
+        with self.sco() as session:
+            return [i.files_base_folder for i in session.query(Media.files_base_folder).all()]
+
     def get_media_by_id(self, id: int) -> Media:
         with self.sco() as session:
             return session.query(Media).filter_by(id=id).first()
 
+    def get_media_ref(self, id: int) -> MediaRef:
+        ref = self.refs.get(id)
+        if ref is not None:
+            return ref
+        with self.sco() as session:
+            row = session.query(Media.id, Media.title, Media.episodes, Media.file_map).filter_by(id=id).first()
+            if not row:
+                return None
+            episodes = {i: list(row.episodes[i]) for i in row.episodes}
+            ref = MediaRef(row.id, row.title, episodes, row.file_map)
+        self.refs.put(id, ref)
+        return ref
+
     def update_file_map(self, title: str, file_map: dict):
         with self.sco() as session:
             media = session.query(Media).filter_by(title=title).first()
             media.file_map = self.to_json(file_map)
             session.commit()
+            self.refs.pop(media.id)
     
+    def update_file_maps(self, file_maps: dict, chunk_size: int = 500):
+        titles = list(file_maps.keys())
+        for i in range(0, len(titles), chunk_size):
+            with self.sco() as session:
+                for media in session.query(Media).filter(Media.title.in_(titles[i:i + chunk_size])).all():
+                    media.file_map = self.to_json(file_maps[media.title])
+                    self.refs.pop(media.id)
+                session.commit()
+
     def add_media(self, media: Media):
-        with self.sco() as session:
-            if not self.get_media(media.title):
-                session.add(media)
+        self.add_media_many([media])
+
+    def add_media_many(self, media: list[Media], chunk_size: int = 500):
+        for i in range(0, len(media), chunk_size):
+            chunk = media[i:i + chunk_size]
+            with self.sco() as session:
+                existing = {t.title for t in session.query(Media.title).filter(
+                    Media.title.in_([m.title for m in chunk])).all()}
+
+                added = []
+                for m in chunk:
+                    if m.title in existing:
+                        continue
+                    existing.add(m.title)
+                    self.set_card_columns(m)
+                    session.add(m)
+                    added.append(m)
+
+                session.flush()
+                cards = [self.create_card(m) for m in added]
                 session.commit()
 
-    def create_and_add_media(self, media_type: str, title: str, media_data: dict, 
-            episodes: dict, file_map: dict, img_map: dict, files_base_folder: str):
-        self.add_media(Media(
+            for card in cards:
+                self.catalog.put(card)
+
+    def create_media(self, media_type: str, title: str, media_data: dict, 
+            episodes: dict, file_map: dict, img_map: dict, files_base_folder: str) -> Media:
+        return Media(
             media_type=media_type, title=title, media_data=media_data, 
             episodes=episodes, file_map=file_map, img_map=img_map, 
-            files_base_folder=files_base_folder))
+            files_base_folder=files_base_folder)
+
+    def create_and_add_media(self, media_type: str, title: str, media_data: dict, 
+            episodes: dict, file_map: dict, img_map: dict, files_base_folder: str):
+        self.add_media(self.create_media(
+            media_type, title, media_data, episodes, file_map, img_map, files_base_folder))
 
     def update_media_data(self, db_id: int, media_type: str, title: str, media_data: dict, 
             episodes: dict, file_map: dict, img_map: dict):
         with self.sco() as session:
             data = session.query(Media).filter_by(id=db_id).first()
+            old_title = data.title
             data.media_type = media_type
             data.title = title
             data.media_data = media_data
             data.episodes = episodes
             data.file_map = file_map
             data.img_map = img_map
+            self.set_card_columns(data)
             session.commit()
+            self.refs.pop(db_id)
+            self.catalog.put(self.create_card(data), old_title)
 
     def clean_title(self, title):
         return " ".join(re.sub(r'[^\w\s]', '', title).split())
 
+    def normalize_title(self, title: str) -> str:
+        return self.clean_title(title).lower()
+
     def create_media_data_dict(self, title: str, year: int, vote: float, 
             vote_count: int, info: str, media_type: str, genres: list) -> dict:
         return {
@@ -0,0 +1,74 @@
+from sqlalchemy import Column, String, Float, JSON
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
+from sqlalchemy.dialects.sqlite import insert
+from index.storage import create_sqlite_engine
+import threading
+import time
+import os
+
+CACHEBASE = declarative_base()
+
+class Response(CACHEBASE):
+    """
+    Response class represents a cached TMDB response keyed by endpoint and params.
+    """
+
+    __tablename__ = 'responses'
+
+    key = Column(String, primary_key=True)
+    data = Column(JSON, nullable=False)
+    created = Column(Float, nullable=False, index=True)
+    expires = Column(Float, nullable=False)
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 20000, evict_every: int = 100) -> None:
+        self.engine = create_sqlite_engine(
+            os.path.join(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                'data', 'tmdb_cache.db'))
+        CACHEBASE.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        self.sco = scoped_session(self.Session)
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.lock = threading.Lock()
+        self.puts = 0
+
+    def get(self, key: str):
+        with self.sco() as session:
+            res = session.query(Response).filter_by(key=key).first()
+            if not res or res.expires < time.time():
+                return None
+            return res.data
+
+    def put(self, key: str, data, ttl: int):
+        now = time.time()
+        # Folders of one show search the same title at once, an upsert never conflicts
+        stmt = insert(Response).values(key=key, data=data, created=now, expires=now + ttl)
+        with self.sco() as session:
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=[Response.key],
+                set_={"data": stmt.excluded.data, "created": stmt.excluded.created,
+                    "expires": stmt.excluded.expires}))
+            session.commit()
+
+        with self.lock:
+            self.puts += 1
+            if self.puts % self.evict_every:
+                return
+        self.evict()
+
+    def evict(self):
+        with self.sco() as session:
+            session.query(Response).filter(Response.expires < time.time()).delete()
+            over = session.query(Response).count() - self.max_entries
+            if over > 0:
+                oldest = session.query(Response.key).order_by(Response.created).limit(over)
+                session.query(Response).filter(
+                    Response.key.in_(oldest.scalar_subquery())).delete(synchronize_session=False)
+            session.commit()
+
+    def clear(self):
+        with self.sco() as session:
+            session.query(Response).delete()
+            session.commit()
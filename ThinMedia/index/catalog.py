@@ -0,0 +1,159 @@
+import threading
+from bisect import bisect_left
+from natsort import natsort_keygen
+import hp
+
+class Card:
+    """
+    Card is the lightweight view of a media row used by the home grid.
+    The hex encoded title and image path used in its links are computed once.
+    """
+
+    __slots__ = ("id", "title", "media_type", "genres", "img_base", "title_hex", "img_hex")
+
+    def __init__(self, id: int, title: str, media_type: str, genres: list, img_base: str) -> None:
+        self.id = id
+        self.title = title
+        self.media_type = media_type
+        self.genres = genres
+        self.img_base = img_base
+        self.title_hex = hp.encode_string(title)
+        self.img_hex = hp.encode_string(img_base)
+
+class Catalog:
+    """
+    Catalog is a process wide cache of the library in natsorted title order.
+    Writes patch it in place so reads never have to touch the database.
+    An optional search index is kept in step with the cached titles,
+    and genre facets map each genre to the set of titles carrying it.
+    Rendered grid fragments are cached per media id until the card changes.
+    """
+
+    def __init__(self, search_index=None) -> None:
+        self.search_index = search_index
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.key = natsort_keygen()
+        self.cards = {}
+        self.order = []
+        self.keys = []
+        self.facets = {}
+        self.snapshot = None
+        self.fragments = {}
+
+    def add_facets(self, card: Card) -> None:
+        for g in card.genres:
+            self.facets.setdefault(g, set()).add(card.title)
+
+    def remove_facets(self, card: Card) -> None:
+        for g in card.genres:
+            titles = self.facets.get(g)
+            if titles is None:
+                continue
+            titles.discard(card.title)
+            if not titles:
+                del self.facets[g]
+
+    def load(self, cards: list[Card]) -> None:
+        with self.lock:
+            self.cards = {i.title: i for i in cards}
+            self.order = sorted(self.cards.keys(), key=self.key)
+            self.keys = [self.key(i) for i in self.order]
+            self.facets = {}
+            for i in cards:
+                self.add_facets(i)
+            self.snapshot = None
+            self.fragments = {}
+            if self.search_index is not None:
+                self.search_index.load(self.order)
+            self.loaded = True
+
+    def ensure(self, loader) -> None:
+        if self.loaded:
+            return
+        with self.lock:
+            if not self.loaded:
+                self.load(loader())
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.loaded = False
+            self.cards, self.order, self.keys, self.facets = {}, [], [], {}
+            self.snapshot = None
+            self.fragments = {}
+
+    def get_all(self) -> dict:
+        with self.lock:
+            if self.snapshot is None:
+                self.snapshot = {i: self.cards[i] for i in self.order}
+            return self.snapshot
+
+    def get(self, title: str) -> Card:
+        return self.cards.get(title)
+
+    def titles_with_genres(self, genres: list[str]) -> set:
+        with self.lock:
+            titles = set()
+            for g in genres:
+                titles |= self.facets.get(g, set())
+            return titles
+
+    def genre_counts(self, titles=None) -> dict:
+        with self.lock:
+            if titles is None:
+                counts = {g: len(self.facets[g]) for g in self.facets}
+            else:
+                titles = set(titles)
+                counts = {g: len(self.facets[g] & titles) for g in self.facets}
+            # A genre with nothing in scope would only match an empty page
+            return {g: counts[g] for g in counts if counts[g]}
+
+    def remove(self, title: str) -> None:
+        with self.lock:
+            if not self.loaded or title not in self.cards:
+                return
+            card = self.cards.pop(title)
+            self.remove_facets(card)
+            self.fragments.pop(card.id, None)
+            pos = bisect_left(self.keys, self.key(title))
+            while self.order[pos] != title:
+                pos += 1
+            del self.order[pos]
+            del self.keys[pos]
+            self.snapshot = None
+            if self.search_index is not None:
+                self.search_index.remove(title)
+
+    def put(self, card: Card, old_title: str = None) -> None:
+        with self.lock:
+            self.fragments.pop(card.id, None)
+            if not self.loaded:
+                return
+            if old_title is not None:
+                self.remove(old_title)
+            if card.title in self.cards:
+                self.remove_facets(self.cards[card.title])
+                self.cards[card.title] = card
+                self.add_facets(card)
+            else:
+                key = self.key(card.title)
+                pos = bisect_left(self.keys, key)
+                self.cards[card.title] = card
+                self.add_facets(card)
+                self.order.insert(pos, card.title)
+                self.keys.insert(pos, key)
+                if self.search_index is not None:
+                    self.search_index.add(card.title)
+            self.snapshot = None
+
+    def render(self, cards, render_card) -> str:
+        # Page cards may come straight from SQL, so a fragment is reused
+        # only while the fields it was rendered from still match.
+        parts = []
+        for card in cards:
+            cached = self.fragments.get(card.id)
+            if cached is None or cached[0] != card.title or cached[1] != card.img_base:
+                cached = (card.title, card.img_base, render_card(card))
+                self.fragments[card.id] = cached
+            parts.append(cached[2])
+        return "".join(parts)
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import requests
+import threading
+import time
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from index.log import LOG
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+class Client:
+    """
+    Client wraps a pooled keep-alive requests session. Requests that fail
+    with 429/5xx are retried with backoff, every attempt takes a token from
+    the host's bucket and throttling responses slow that bucket for everyone.
+    """
+
+    def __init__(self, limiter, pool_size: int = 8,
+            retries: int = 3, backoff: float = 0.5, timeout: int = 30) -> None:
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.retry_status = [429, 500, 502, 503, 504]
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def record(self, host: str, elapsed: float, error: bool, retry: bool):
+        with self.lock:
+            stats = self.timings.setdefault(
+                host, {"requests": 0, "errors": 0, "retries": 0, "time": 0.0})
+            stats["requests"] += 1
+            stats["errors"] += error
+            stats["retries"] += retry
+            stats["time"] += elapsed
+
+    def get_delay(self, response, attempt: int) -> float:
+        if response is not None and response.headers.get("Retry-After"):
+            try: return float(response.headers["Retry-After"])
+            except ValueError: pass
+        return self.backoff * (2 ** attempt)
+
+    def get(self, url: str, headers: dict = {}):
+        host = urlparse(url).netloc
+        response = None
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire(host)
+            start = time.time()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                LOG.verbose(f"Request failed: {host} {e}")
+                response = None
+
+            retry = response is None or response.status_code in self.retry_status
+            self.record(host, time.time() - start, response is None or response.status_code >= 400, retry)
+            if response is not None:
+                self.limiter.update(host, response.headers)
+                if response.status_code < 400:
+                    self.limiter.success(host)
+            if not retry or attempt == self.retries:
+                return response
+
+            delay = self.get_delay(response, attempt)
+            if response is not None and response.status_code == 429:
+                # The limiter holds everyone on this host for the delay
+                self.limiter.throttle(host, delay)
+                continue
+            time.sleep(delay)
+        return response
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                i: dict(self.timings[i], avg_ms=round(
+                    1000 * self.timings[i]["time"] / max(1, self.timings[i]["requests"]), 1))
+                for i in self.timings}
+
+    def log_stats(self):
+        stats = self.stats()
+        for i in stats:
+            LOG.verbose(
+                f"Host {i}: {stats[i]['requests']} requests, {stats[i]['retries']} retries, "
+                f"{stats[i]['errors']} errors, avg {stats[i]['avg_ms']}ms")
+
+class AsyncResponse:
+    """
+    AsyncResponse holds a fully read aiohttp response with the parts of the
+    requests.Response interface the TMDB client uses.
+    """
+
+    def __init__(self, status_code: int, headers, content: bytes) -> None:
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+class AsyncClient:
+    """
+    AsyncClient is the aiohttp counterpart of Client, with the same retries,
+    limiter and timings. It shares the Client's stats so both paths report
+    together. Only usable when aiohttp is installed.
+    """
+
+    def __init__(self, client: Client, pool_size: int = 100) -> None:
+        self.client = client
+        self.pool_size = pool_size
+        self.session = None
+
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.client.timeout))
+        return self.session
+
+    async def fetch(self, url: str, headers: dict):
+        session = await self.get_session()
+        try:
+            async with session.get(url, headers=headers) as response:
+                return AsyncResponse(response.status, response.headers, await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            LOG.verbose(f"Request failed: {urlparse(url).netloc} {e}")
+            return None
+
+    async def get(self, url: str, headers: dict = {}):
+        client, host = self.client, urlparse(url).netloc
+        response = None
+        for attempt in range(client.retries + 1):
+            await client.limiter.acquire_async(host)
+            start = time.time()
+            response = await self.fetch(url, headers)
+
+            retry = response is None or response.status_code in client.retry_status
+            client.record(host, time.time() - start, response is None or response.status_code >= 400, retry)
+            if response is not None:
+                client.limiter.update(host, response.headers)
+                if response.status_code < 400:
+                    client.limiter.success(host)
+            if not retry or attempt == client.retries:
+                return response
+
+            delay = client.get_delay(response, attempt)
+            if response is not None and response.status_code == 429:
+                client.limiter.throttle(host, delay)
+                continue
+            await asyncio.sleep(delay)
+        return response
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
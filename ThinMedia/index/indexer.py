@@ -1,12 +1,17 @@
 from index.tmdb import TMDB
 from index.base import DB
 from index.log import LOG
-from guessit import guessit
+from index.manifest import Manifest
+from index.parse import Parser
+from index.watcher import Watcher
+from index.jobs import JobQueue, JobContext
 from rapidfuzz import process, fuzz
+import asyncio
 import os
 import json
-import threading
 import glob
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class Indexer:
     def __init__(self) -> None:
@@ -15,11 +20,31 @@ class Indexer:
         self.config = self.load_config()
         self.use = self.config['indexer']
         self.media_extensions = ['.mp4', '.mkv', '.avi']
-        self.tmdb = TMDB("", int(self.config["img_s"]), self.config["use_episode_img"])
+        self.parser = Parser(workers=int(self.config.get("parse_workers", multiprocessing.cpu_count())))
+        self.manifest = Manifest(self.guess_episodes, self.is_media_file)
+        self.index_workers = int(self.config.get("index_workers", 8))
+        self.match_workers = int(self.config.get("match_workers", 4))
+        self.write_batch = int(self.config.get("write_batch", 200))
+        self.tmdb = TMDB(
+            "", int(self.config["img_s"]), self.config["use_episode_img"], 
+            int(self.config.get("io_workers", 8)), 
+            int(self.config.get("cpu_workers", multiprocessing.cpu_count())),
+            self.config.get("cache_ttl", {}), int(self.config.get("cache_size", 20000)),
+            self.config.get("img_format", "jpg"), int(self.config.get("img_quality", 85)),
+            self.config.get("img_widths", [320, 480, 960]),
+            float(self.config.get("api_rate", 30)), float(self.config.get("img_rate", 50)),
+            int(self.config.get("async_pool", 100)))
         self.init_tmdb(self.config["tmdb_api_key"])
-        self.lock = threading.Lock()
-        self.is_running_awc = False
-        self.is_running_rescan = False
+        self.jobs = JobQueue()
+        self.jobs.register("rescan", self.rescan_media, unique=True)
+        self.jobs.register("import", self.import_media)
+        self.jobs.start()
+        self.watcher = None
+        if self.config.get("watch", False):
+            self.watcher = Watcher(
+                self.config['paths'], self.update_changed_paths, self.config.get("watch_mode", "auto"),
+                float(self.config.get("watch_debounce", 5)), float(self.config.get("watch_poll_interval", 60)))
+            self.watcher.start()
 
     def init_tmdb(self, api_key) -> bool:
         self.tmdb.api_key = api_key
@@ -39,7 +64,7 @@ class Indexer:
             exit(0)
 
     def extract_title(self, title: str):
-        parsed_title = guessit(title)
+        parsed_title = self.parser.parse(title)
         
         if not parsed_title: 
             return []
@@ -79,9 +104,12 @@ class Indexer:
         return None
 
     def create_tmdb_data(self, data):
+        return self.tmdb.run(self.create_tmdb_data_async(data))
+
+    async def create_tmdb_data_async(self, data):
         if data["media_type"] == "movie":
-            return self.tmdb.create_movie_data(data["id"])
-        return self.tmdb.create_tv_data(data["id"])
+            return await self.tmdb.create_movie_data_async(data["id"])
+        return await self.tmdb.create_tv_data_async(data["id"])
 
     def search(self, title: str):
         if self.use == "tmdb": 
@@ -90,45 +118,66 @@ class Indexer:
     def is_media_file(self, file_path) -> bool:
         return any(file_path.lower().endswith(ext) for ext in self.media_extensions)
 
-    def get_all_file_paths(self, folder_path) -> list[str]:
-        file_paths = []
-        for folder_name, _, filenames in os.walk(folder_path):
-            for filename in filenames:
-                file_path = os.path.join(folder_name, filename)
-                if self.is_media_file(file_path):
-                    file_paths.append(file_path)
-        return file_paths
+    def has_media_file(self, folder: str) -> bool:
+        stack = [folder]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif self.is_media_file(entry.name):
+                            return True
+            except OSError:
+                continue
+        return False
 
-    def get_base_folder(self, file_path: str, base: str):
-        return file_path.replace(base, "").split("/")[0]
+    def find_base_folders(self, base: str) -> list[str]:
+        # A top level entry counts once any media file is found under it,
+        # the rest of that folder is never listed.
+        try:
+            with os.scandir(base) as entries:
+                entries = list(entries)
+        except OSError as e:
+            LOG.log(f"Could not scan {base}: {e}")
+            return []
 
-    def get_base_paths(self, path):
-        all_files = self.get_all_file_paths(path)
-        return {self.get_base_folder(f, path): path for f in all_files}
+        folders = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if self.has_media_file(entry.path):
+                    folders.append(entry.name)
+            elif self.is_media_file(entry.name):
+                folders.append(entry.name)
+        return folders
 
-    def _map_file_guess(self, file: str, is_key_int: bool):
-        file_data = guessit(os.path.basename(file))
+    def get_episode(self, file_data: dict):
         if "season" not in file_data or "episode" not in file_data: 
-            return "", ""
-        if is_key_int:
-            return file_data["season"], file_data["episode"]
-        return str(file_data["season"]), str(file_data["episode"])
+            return None, None
+        season, episode = file_data["season"], file_data["episode"]
+        # Multi episode files are mapped to their first episode
+        if isinstance(season, list): season = season[0]
+        if isinstance(episode, list): episode = episode[0]
+        return season, episode
+
+    def guess_episodes(self, file_names: list[str]) -> dict:
+        parsed = self.parser.parse_many(file_names)
+        return {i: self.get_episode(parsed[i]) for i in parsed}
 
     def map_files(self, base: str, season: dict, media_type: str):
-        files = self.get_all_file_paths(base)
+        files = self.manifest.scan(base)
         if media_type == "movie":
-            for f in files:
-                if self.is_media_file(f):
-                    return {0: {0: f}}
+            for f, _, _ in files:
+                return {0: {0: f}}
 
         is_key_int = isinstance(list(season.keys())[0], int)
 
         file_map = {}
-        for i in files:
-            if not self.is_media_file(i): 
+        for i, file_season, file_episode in files:
+            if file_season is None or file_episode is None:
                 continue
-            
-            file_season, file_episode = self._map_file_guess(i, is_key_int)
+            if not is_key_int:
+                file_season, file_episode = str(file_season), str(file_episode)
 
             if file_season not in season: 
                 continue 
@@ -141,22 +190,61 @@ class Indexer:
 
         return file_map
 
-    def scan_and_index_current_media(self):
-        with self.lock:
-            if self.is_running_rescan:
-                LOG.verbose("Rescan is running, exiting.")
-                return None
-            self.is_running_rescan = True
+    def scan_and_index_current_media(self) -> int:
+        return self.jobs.submit("rescan", {i: None for i in DB.get_all()})
 
-        get_all = DB.get_all_sql()
-        if get_all:
-            for i in get_all:
-                yield f"Indexing: {i.title}"
-                DB.update_file_map(i.title, self.map_files(i.files_base_folder, i.episodes, i.media_type))
-                LOG.verbose(f"Updated file map for: {i.title}")
+    def write_file_maps(self, job: JobContext, file_maps: dict):
+        DB.update_file_maps(file_maps)
+        LOG.verbose(f"Updated file maps for {len(file_maps)} titles.")
+        job.checkpoint(list(file_maps))
 
-        with self.lock:
-            self.is_running_rescan = False
+    def rescan_media(self, job: JobContext, titles: dict):
+        file_maps = {}
+        for i in DB.get_all_sql():
+            if job.cancelled:
+                break
+            if i.title not in titles:
+                continue
+            try:
+                file_maps[i.title] = self.map_files(i.files_base_folder, i.episodes, i.media_type)
+            except Exception as e:
+                LOG.verbose(f"Could not map files for {i.title}: {e}")
+            job.progress(f"Indexing: {i.title}")
+            if len(file_maps) >= self.write_batch:
+                self.write_file_maps(job, file_maps)
+                file_maps = {}
+
+        if file_maps:
+            self.write_file_maps(job, file_maps)
+
+    def get_owner_folder(self, path: str, folders: list[str]):
+        for i in folders:
+            if path == i or path.startswith(i.rstrip(os.sep) + os.sep):
+                return i
+        return None
+
+    def update_changed_paths(self, paths: set, overflow: bool = False):
+        folders = DB.get_base_folders()
+        if overflow:
+            # Events were lost, so every title below the changed roots is remapped
+            owners = {f for f in folders if any(self.get_owner_folder(f, [i]) for i in paths)}
+        else:
+            # A path no title owns, like the library root, only gained or lost title folders
+            owners = {self.get_owner_folder(i, folders) for i in paths}
+            owners.discard(None)
+
+        file_maps = {}
+        for i in owners:
+            media = DB.get_media_by_path(i)
+            if not media:
+                continue
+            try:
+                file_maps[media.title] = self.map_files(i, media.episodes, media.media_type)
+            except Exception as e:
+                LOG.verbose(f"Could not map files for {media.title}: {e}")
+        if file_maps:
+            DB.update_file_maps(file_maps)
+            LOG.verbose(f"Updated file maps of {len(file_maps)} titles after changes.")
 
     def update_media_by_indexer_id(self, media_type: str, indexer_id: str, media_path: str):
         media_data = DB.get_media_by_path(media_path)
@@ -176,55 +264,107 @@ class Indexer:
 
         return media["title"]
 
+    def find_new_folders(self, mapped: dict) -> dict:
+        known = set(DB.get_base_folders())
+        folders = {}
+        for base in self.config['paths']:
+            for name in self.find_base_folders(base):
+                path = base + name
+                if path in mapped:
+                    continue
+                if path in known:
+                    LOG.verbose(f"Media already exists: {path}.")
+                    continue
+                folders[path] = name
+        return folders
+
+    def match_folders(self, folders: dict):
+        self.parser.parse_many(list(folders.values()))
+        pool = ThreadPoolExecutor(max_workers=self.match_workers)
+        try:
+            tasks = {pool.submit(self.search_tmdb, folders[i]): i for i in folders}
+            for task in as_completed(tasks):
+                path = tasks[task]
+                try:
+                    data = task.result()
+                except Exception as e:
+                    LOG.verbose(f"Failed to match {path}: {e}")
+                    data = None
+                yield path, data
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
     def get_matches(self, mapped: dict):
-        for i in self.config['paths']:
-            paths = self.get_base_paths(i)
-            for p in paths:
-                path = paths[p]+p
-                if path not in mapped:
-                    LOG.verbose(f"Indexing - folder: {p} path: {paths[p]}")
-                    media = DB.get_media_by_path(path) 
-                    if not media:
-                        data = self.search_tmdb(p)
-                        if not data: 
-                            mapped[path] = None
-                        else: 
-                            mapped[path] = data
-                    else:
-                        LOG.verbose(f"Media already exists: {media.title}.")
+        for path, data in self.match_folders(self.find_new_folders(mapped)):
+            mapped[path] = data
         return mapped
 
-    def index_media_awc(self, matches: dict):
-        with self.lock:
-            if self.is_running_awc: 
-                LOG.verbose(f"Indexer is running, exiting.")
-                return None
-            self.is_running_awc = True
-
-        for i in matches:
+    async def create_match_data(self, path: str, at: dict, limit: asyncio.Semaphore):
+        async with limit:
             s = None
-            at = matches[i]
-
-            if at["id"] and at["id_type"]:
-                s = self.create_tmdb_data({"id": at["id"], "media_type": at["id_type"]})
-            elif at["data"]:
-                s = self.create_tmdb_data({"id": at["data"]["id"], "media_type": at["data"]["media_type"]})
-            
-            if not s: 
-                LOG.verbose(f"Could not create media: {i}")
-                continue
-
-            media, seasons, img = s
-
-            DB.create_and_add_media(
-                media_type=media["type"], title=media["title"],
-                media_data=media, episodes=seasons, 
-                file_map=self.map_files(i, seasons, media["type"]), 
-                img_map=img, files_base_folder=i)
-
-            LOG.verbose(f"Added media: {media['title']}")
-
-        with self.lock:
-            self.is_running_awc = False
+            try:
+                if at["id"] and at["id_type"]:
+                    s = await self.create_tmdb_data_async({"id": at["id"], "media_type": at["id_type"]})
+                elif at["data"]:
+                    s = await self.create_tmdb_data_async(
+                        {"id": at["data"]["id"], "media_type": at["data"]["media_type"]})
+                if not s:
+                    return None
+
+                media, seasons, img = s
+                file_map = await asyncio.to_thread(self.map_files, path, seasons, media["type"])
+            except Exception as e:
+                # One bad title is skipped, it must not fail the whole import job
+                LOG.verbose(f"Failed to create media data for {path}: {e}")
+                return None
+            return media, seasons, img, file_map
+
+    def index_media_awc(self, matches: dict) -> int:
+        return self.jobs.submit("import", matches)
+
+    def write_media(self, job: JobContext, pending: list, paths: list[str]):
+        if pending:
+            DB.add_media_many(pending)
+            LOG.verbose(f"Added {len(pending)} media.")
+        job.checkpoint(paths)
+
+    def import_media(self, job: JobContext, matches: dict):
+        # Titles run as coroutines on the TMDB loop, index_workers of them at a time
+        pending, paths = [], []
+        limit = asyncio.Semaphore(self.index_workers)
+        tasks = {self.tmdb.submit(self.create_match_data(i, matches[i], limit)): i for i in matches}
+        try:
+            for task in as_completed(tasks):
+                if job.cancelled:
+                    break
+                i = tasks[task]
+                s = task.result()
+                paths.append(i)
+                if not s: 
+                    LOG.verbose(f"Could not create media: {i}")
+                    job.progress(f"Could not create media: {i}")
+                else:
+                    media, seasons, img, file_map = s
+
+                    pending.append(DB.create_media(
+                        media_type=media["type"], title=media["title"],
+                        media_data=media, episodes=seasons, 
+                        file_map=file_map, img_map=img, files_base_folder=i))
+
+                    LOG.verbose(f"Fetched media: {media['title']}")
+                    job.progress(f"Fetched media: {media['title']}")
+                    self.tmdb.workers.log_stats()
+                    self.tmdb.client.log_stats()
+                    self.tmdb.limiter.log_stats()
+
+                if len(paths) >= self.write_batch:
+                    self.write_media(job, pending, paths)
+                    pending, paths = [], []
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if paths:
+            self.write_media(job, pending, paths)
 
 manager = Indexer()
@@ -0,0 +1,215 @@
+from sqlalchemy import Column, Integer, String, Float, Text, JSON
+from index.base import DECBASE, DB
+from index.log import LOG
+import queue
+import threading
+import time
+
+class Job(DECBASE):
+    """
+    Job class represents a queued indexer job, its items and the keys
+    that have already been committed.
+    """
+
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    state = Column(String, nullable=False, index=True)
+    items = Column(JSON, nullable=False)
+    done = Column(JSON, nullable=False)
+    message = Column(String, default="")
+    error = Column(Text)
+    created = Column(Float, nullable=False)
+    started = Column(Float)
+    finished = Column(Float)
+
+class JobContext:
+    """
+    JobContext is handed to a job handler to report progress, commit
+    checkpoints and check for cancellation.
+    """
+
+    def __init__(self, jobs, job_id: int, kind: str, total: int, done: int) -> None:
+        self.jobs = jobs
+        self.id = job_id
+        self.kind = kind
+        self.total = total
+        self.done = done
+        self.processed = 0
+        self.start = time.time()
+        self.message = ""
+
+    @property
+    def cancelled(self) -> bool:
+        return self.id in self.jobs.cancelled
+
+    def progress(self, message: str):
+        self.processed += 1
+        self.message = message
+        self.jobs.publish(self)
+
+    def checkpoint(self, keys: list[str]):
+        if keys:
+            self.jobs.checkpoint(self.id, keys, self.message)
+
+    def eta(self) -> float:
+        if not self.processed:
+            return None
+        rate = self.processed / max(time.time() - self.start, 1e-6)
+        return max(self.total - self.done - self.processed, 0) / rate
+
+class JobQueue:
+    """
+    JobQueue persists indexer jobs in the jobs table and runs them one at a
+    time on a worker thread. Handlers only receive the items that are not
+    yet checkpointed, so a job interrupted by a restart resumes where it
+    stopped.
+    """
+
+    def __init__(self, notify=None, publish_interval: float = 1) -> None:
+        DECBASE.metadata.create_all(DB.engine)
+        self.handlers = {}
+        self.unique = set()
+        self.notify = notify
+        self.publish_interval = publish_interval
+        self.last_publish = 0
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.cancelled = set()
+        self.running = None
+
+    def register(self, kind: str, handler, unique: bool = False):
+        # A unique kind covers everything on its own, a second one is not queued
+        self.handlers[kind] = handler
+        if unique:
+            self.unique.add(kind)
+
+    def start(self):
+        with DB.sco() as session:
+            for job in session.query(Job).filter(Job.state.in_(["queued", "running"])).order_by(Job.id).all():
+                if job.state == "running":
+                    LOG.log(f"Resuming interrupted {job.kind} job {job.id}.")
+                    job.state = "queued"
+                self.queue.put(job.id)
+            session.commit()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, kind: str, items: dict) -> int:
+        with self.lock:
+            active = self.get_active(kind) if kind in self.unique else None
+            if active is not None:
+                LOG.verbose(f"A {kind} job is already active: {active}")
+                return active
+            with DB.sco() as session:
+                job = Job(kind=kind, state="queued", items=items, done=[], created=time.time())
+                session.add(job)
+                session.commit()
+                job_id = job.id
+        self.queue.put(job_id)
+        LOG.verbose(f"Queued {kind} job {job_id} with {len(items)} items.")
+        return job_id
+
+    def get_active(self, kind: str = None) -> int:
+        with DB.sco() as session:
+            query = session.query(Job.id).filter(Job.state.in_(["queued", "running"]))
+            if kind:
+                query = query.filter(Job.kind == kind)
+            job = query.order_by(Job.id).first()
+            return job.id if job else None
+
+    def cancel(self, job_id: int):
+        with DB.sco() as session:
+            job = session.query(Job).filter_by(id=job_id).first()
+            if not job or job.state not in ["queued", "running"]:
+                return
+            if job.state == "queued":
+                job.state = "cancelled"
+                job.finished = time.time()
+                session.commit()
+                return
+        self.cancelled.add(job_id)
+
+    def cancel_active(self):
+        with DB.sco() as session:
+            ids = [i.id for i in session.query(Job.id).filter(Job.state.in_(["queued", "running"])).all()]
+        for i in ids:
+            self.cancel(i)
+
+    def status(self, job_id: int) -> dict:
+        running = self.running
+        if running and running.id == job_id:
+            return self.to_dict(running, "running")
+        with DB.sco() as session:
+            job = session.query(Job).filter_by(id=job_id).first()
+            if not job:
+                return None
+            return {
+                "id": job.id, "kind": job.kind, "state": job.state, "message": job.message or "",
+                "total": len(job.items), "done": len(job.done), "eta": None, "error": job.error}
+
+    def to_dict(self, ctx: JobContext, state: str) -> dict:
+        return {
+            "id": ctx.id, "kind": ctx.kind, "state": state, "message": ctx.message,
+            "total": ctx.total, "done": ctx.done + ctx.processed, "eta": ctx.eta(), "error": None}
+
+    def publish(self, ctx: JobContext, state: str = "running", force: bool = False):
+        if not self.notify:
+            return
+        now = time.time()
+        if not force and now - self.last_publish < self.publish_interval:
+            return
+        self.last_publish = now
+        try:
+            self.notify(self.to_dict(ctx, state))
+        except Exception as e:
+            LOG.verbose(f"Could not publish job progress: {e}")
+
+    def checkpoint(self, job_id: int, keys: list[str], message: str):
+        with DB.sco() as session:
+            job = session.query(Job).filter_by(id=job_id).first()
+            job.done = job.done + list(keys)
+            job.message = message
+            session.commit()
+
+    def finish(self, job_id: int, state: str, error: str = None):
+        with DB.sco() as session:
+            job = session.query(Job).filter_by(id=job_id).first()
+            job.state = state
+            job.error = error
+            job.finished = time.time()
+            session.commit()
+
+    def run(self):
+        while True:
+            job_id = self.queue.get()
+            with DB.sco() as session:
+                job = session.query(Job).filter_by(id=job_id).first()
+                if not job or job.state != "queued":
+                    continue
+                job.state = "running"
+                job.started = job.started or time.time()
+                session.commit()
+                kind = job.kind
+                done = set(job.done)
+                items = {i: job.items[i] for i in job.items if i not in done}
+                ctx = JobContext(self, job_id, kind, len(job.items), len(done))
+
+            handler = self.handlers.get(kind)
+            self.running = ctx
+            state, error = "done", None
+            try:
+                if handler is None:
+                    raise ValueError(f"No handler for job kind: {kind}")
+                handler(ctx, items)
+                if ctx.cancelled:
+                    state = "cancelled"
+            except Exception as e:
+                LOG.log(f"Job {job_id} failed: {e}")
+                state, error = "failed", str(e)
+
+            self.finish(job_id, state, error)
+            self.running = None
+            self.cancelled.discard(job_id)
+            LOG.verbose(f"Job {job_id} {state} after {time.time() - ctx.start:.1f}s.")
+            self.publish(ctx, state, True)
@@ -0,0 +1,42 @@
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    LRUCache is a thread safe least recently used cache whose entries
+    also expire after ttl seconds.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.time():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.time() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
@@ -0,0 +1,125 @@
+from sqlalchemy import Column, Integer, String, Float, JSON
+from index.base import DECBASE, DB
+import os
+
+class ManifestDir(DECBASE):
+    """
+    ManifestDir records a scanned directory, its mtime and child directories.
+    """
+
+    __tablename__ = 'manifest_dirs'
+
+    path = Column(String, primary_key=True)
+    mtime = Column(Float, nullable=False)
+    dirs = Column(JSON, nullable=False)
+
+class ManifestFile(DECBASE):
+    """
+    ManifestFile records a media file with its size, mtime and parsed episode.
+    """
+
+    __tablename__ = 'manifest_files'
+
+    path = Column(String, primary_key=True)
+    dir = Column(String, nullable=False, index=True)
+    size = Column(Integer, nullable=False)
+    mtime = Column(Float, nullable=False)
+    season = Column(Integer)
+    episode = Column(Integer)
+
+class Manifest:
+    """
+    Manifest keeps the last scan of every media folder so a rescan only lists
+    directories whose mtime changed and only parses new or changed files.
+    """
+
+    def __init__(self, guess_many, is_media_file) -> None:
+        DECBASE.metadata.create_all(DB.engine)
+        self.guess_many = guess_many
+        self.is_media_file = is_media_file
+
+    def is_under(self, path: str, base: str) -> bool:
+        return path == base or path.startswith(base.rstrip(os.sep) + os.sep)
+
+    def load(self, session, base: str):
+        dirs = {
+            i.path: i for i in session.query(ManifestDir).filter(
+                ManifestDir.path.startswith(base, autoescape=True)).all()
+            if self.is_under(i.path, base)}
+        files = {}
+        for i in session.query(ManifestFile).filter(
+                ManifestFile.dir.startswith(base, autoescape=True)).all():
+            if self.is_under(i.dir, base):
+                files.setdefault(i.dir, {})[i.path] = i
+        return dirs, files
+
+    def scan_dir(self, path: str, stored: dict):
+        dirs, files = [], {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # Directory links are not followed, a link loop would repeat every file
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                elif entry.is_file() and self.is_media_file(entry.path):
+                    st = entry.stat()
+                    old = stored.get(entry.path)
+                    if old and old.size == st.st_size and old.mtime == st.st_mtime:
+                        files[entry.path] = old
+                        continue
+                    files[entry.path] = ManifestFile(
+                        path=entry.path, dir=path, size=st.st_size, mtime=st.st_mtime)
+        return sorted(dirs), files
+
+    def scan(self, base: str) -> list[tuple]:
+        # Nothing is written until the walk and the parse are done, the parser
+        # keeps its own session and must not wait on this one's write lock.
+        found, pending, removed, changed_dirs = [], [], [], []
+        with DB.sco() as session:
+            dirs, files = self.load(session, base)
+            seen = set()
+
+            stack = [base]
+            while stack:
+                path = stack.pop()
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                seen.add(path)
+
+                stored = dirs.get(path)
+                stored_files = files.get(path, {})
+                if stored and stored.mtime == mtime:
+                    children, dir_files = stored.dirs, stored_files
+                else:
+                    try:
+                        children, dir_files = self.scan_dir(path, stored_files)
+                    except OSError:
+                        continue
+                    removed.extend(stored_files[i] for i in stored_files if i not in dir_files)
+                    for i in dir_files.values():
+                        if i is not stored_files.get(i.path):
+                            pending.append(i)
+                    changed_dirs.append(ManifestDir(path=path, mtime=mtime, dirs=children))
+
+                found.extend(dir_files[i] for i in sorted(dir_files))
+                stack.extend(os.path.join(path, i) for i in reversed(children))
+
+            for i in dirs:
+                if i not in seen:
+                    removed.append(dirs[i])
+                    removed.extend(files.get(i, {}).values())
+
+            # New and changed files are parsed in one batch
+            guesses = self.guess_many([os.path.basename(i.path) for i in pending])
+            for i in pending:
+                i.season, i.episode = guesses[os.path.basename(i.path)]
+
+            for i in removed:
+                session.delete(i)
+            for i in changed_dirs + pending:
+                session.merge(i)
+
+            found = [(i.path, i.season, i.episode) for i in found]
+            session.commit()
+            return found
@@ -0,0 +1,122 @@
+from sqlalchemy import Column, String, JSON
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.sqlite import insert
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from guessit import guessit
+from index.base import DECBASE, DB
+from index.log import LOG
+import multiprocessing
+import threading
+
+class ParsedName(DECBASE):
+    """
+    ParsedName stores the guessit fields the indexer uses, per file or folder name.
+    """
+
+    __tablename__ = 'parsed_names'
+
+    name = Column(String, primary_key=True)
+    data = Column(JSON, nullable=False)
+
+def guess(name: str) -> dict:
+    data = guessit(name)
+    parsed = {}
+    for i in ["title", "episode_title", "season", "episode"]:
+        if i not in data:
+            continue
+        value = data[i]
+        parsed[i] = list(value) if isinstance(value, list) else value
+    return parsed
+
+class Parser:
+    """
+    Parser memoizes guessit results in an in-memory LRU backed by the
+    parsed_names table, and fans bulk misses out over a process pool.
+    """
+
+    def __init__(self, cache_size: int = 50000, workers: int = None, min_batch: int = 64) -> None:
+        DECBASE.metadata.create_all(DB.engine)
+        self.cache_size = cache_size
+        self.workers = workers or multiprocessing.cpu_count()
+        self.min_batch = min_batch
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        # Own sessions, callers such as the manifest scan may hold DB.sco open
+        self.Session = sessionmaker(bind=DB.engine)
+        self.pool = None
+        if self.workers > 1:
+            # One long lived pool, forked here while the indexer has not started
+            # any threads yet. A fork context launches every worker on first use.
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+            self.pool.submit(int).result()
+
+    def remember(self, name: str, data: dict):
+        with self.lock:
+            self.cache[name] = data
+            self.cache.move_to_end(name)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def lookup(self, name: str):
+        with self.lock:
+            data = self.cache.get(name)
+            if data is not None:
+                self.cache.move_to_end(name)
+            return data
+
+    def load(self, names: list[str]) -> dict:
+        found = {}
+        with self.Session() as session:
+            for i in range(0, len(names), 500):
+                for row in session.query(ParsedName).filter(ParsedName.name.in_(names[i:i + 500])).all():
+                    found[row.name] = row.data
+        return found
+
+    def store(self, parsed: dict):
+        # Threads parsing the same names race here, an upsert never conflicts
+        names = list(parsed)
+        with self.Session() as session:
+            for i in range(0, len(names), 500):
+                stmt = insert(ParsedName).values(
+                    [{"name": n, "data": parsed[n]} for n in names[i:i + 500]])
+                session.execute(stmt.on_conflict_do_update(
+                    index_elements=[ParsedName.name], set_={"data": stmt.excluded.data}))
+            session.commit()
+
+    def parse(self, name: str) -> dict:
+        return self.parse_many([name])[name]
+
+    def parse_many(self, names: list[str]) -> dict:
+        res, misses = {}, []
+        for i in set(names):
+            data = self.lookup(i)
+            if data is None:
+                misses.append(i)
+            else:
+                res[i] = data
+
+        if misses:
+            stored = self.load(misses)
+            misses = [i for i in misses if i not in stored]
+            res.update(stored)
+
+        if misses:
+            parsed = None
+            if len(misses) >= self.min_batch and self.pool is not None:
+                chunksize = max(1, len(misses) // (self.workers * 4))
+                try:
+                    parsed = dict(zip(misses, self.pool.map(guess, misses, chunksize=chunksize)))
+                except BrokenProcessPool as e:
+                    LOG.log(f"Parse pool failed, parsing in process: {e}")
+                    self.pool = None
+            if parsed is None:
+                parsed = {i: guess(i) for i in misses}
+            self.store(parsed)
+            res.update(parsed)
+
+        for i in res:
+            self.remember(i, res[i])
+        return res
@@ -0,0 +1,163 @@
+import asyncio
+import threading
+import time
+from index.log import LOG
+
+class TokenBucket:
+    """
+    TokenBucket refills continuously at rate tokens per second up to burst.
+    Callers reserve tokens up front and sleep outside the lock, so waiters
+    are served in order without a refill thread. A throttle halves the rate,
+    at most once per pause window, and pauses the bucket. Nothing refills
+    during a pause, so its waiters resume at the lower rate one after another.
+    Each success adds the rate back additively.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float = None, min_rate: float = 1,
+            increase: float = 0.1, decrease: float = 0.5) -> None:
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst or rate
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.paused_until = 0
+        self.shifted = 0.0
+        self.lock = threading.Lock()
+
+        self.start = self.last
+        self.acquired = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
+
+    def refill(self, now: float):
+        # Nothing accrues before last, which a pause moves to its end
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def reserve(self, size: float = 1) -> tuple[float, float]:
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens -= size
+            # Debt is paid off at rate from last, so a paused bucket spreads its waiters after the pause
+            wait = max(self.last - now, 0) + max(-self.tokens, 0) / self.rate
+            self.acquired += size
+            self.waited += wait
+            self.max_wait = max(self.max_wait, wait)
+            return wait, self.shifted
+
+    def shift_since(self, shifted: float) -> tuple[float, float]:
+        with self.lock:
+            return self.shifted - shifted, self.shifted
+
+    def acquire(self, size: float = 1):
+        wait, shifted = self.reserve(size)
+        while wait > 0:
+            time.sleep(wait)
+            # A pause that started while this caller slept pushes its slot back as well
+            wait, shifted = self.shift_since(shifted)
+
+    async def acquire_async(self, size: float = 1):
+        wait, shifted = self.reserve(size)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait, shifted = self.shift_since(shifted)
+
+    def extend_pause(self, now: float, seconds: float):
+        self.refill(now)
+        until = now + seconds
+        if until <= self.last:
+            return
+        self.shifted += until - self.last
+        self.tokens = min(self.tokens, 0)
+        self.last = until
+        self.paused_until = until
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.extend_pause(time.monotonic(), seconds)
+
+    def throttle(self, seconds: float):
+        with self.lock:
+            now = time.monotonic()
+            self.throttled += 1
+            # In flight requests of one window often all get 429, that is one decrease
+            if now >= self.paused_until:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.extend_pause(now, seconds)
+        LOG.verbose(f"Rate limit {self.name}: throttled for {seconds:.1f}s, rate now {self.rate:.1f}/s")
+
+    def success(self):
+        if self.rate >= self.max_rate:
+            return
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def stats(self) -> dict:
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start, 1e-6)
+            return {
+                "rate": round(self.rate, 2),
+                "acquired": int(self.acquired),
+                "throttled": self.throttled,
+                "avg_wait_ms": round(1000 * self.waited / max(1, self.acquired), 1),
+                "max_wait_ms": round(1000 * self.max_wait, 1),
+                "utilization": round(self.acquired / (self.burst + elapsed * self.max_rate), 3)}
+
+class RateLimiter:
+    """
+    RateLimiter keeps a separate token bucket per host, so image downloads
+    do not eat into the API budget.
+    """
+
+    def __init__(self, buckets: dict, default: TokenBucket) -> None:
+        self.buckets = buckets
+        self.default = default
+
+    def get(self, host: str) -> TokenBucket:
+        return self.buckets.get(host, self.default)
+
+    def acquire(self, host: str, size: float = 1):
+        self.get(host).acquire(size)
+
+    async def acquire_async(self, host: str, size: float = 1):
+        await self.get(host).acquire_async(size)
+
+    def throttle(self, host: str, seconds: float):
+        self.get(host).throttle(seconds)
+
+    def success(self, host: str):
+        self.get(host).success()
+
+    def update(self, host: str, headers):
+        # Servers that advertise their window let us wait before hitting a 429
+        remaining, reset = headers.get("X-RateLimit-Remaining"), headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining, reset = int(remaining), float(reset)
+        except ValueError:
+            return
+        if remaining <= 0:
+            # Reset is either an epoch timestamp or seconds left in the window
+            delay = reset - time.time() if reset > 1e9 else reset
+            if delay > 0:
+                self.get(host).pause(delay)
+
+    def stats(self) -> dict:
+        return {i.name: i.stats() for i in [self.default, *self.buckets.values()]}
+
+    def log_stats(self):
+        stats = self.stats()
+        for i in stats:
+            LOG.verbose(
+                f"Rate limit {i}: {stats[i]['rate']}/s, {stats[i]['acquired']} acquired, "
+                f"{stats[i]['throttled']} throttled, avg wait {stats[i]['avg_wait_ms']}ms, "
+                f"max wait {stats[i]['max_wait_ms']}ms, utilization {stats[i]['utilization']:.0%}")
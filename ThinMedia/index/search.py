@@ -0,0 +1,90 @@
+import threading
+from collections import Counter
+from rapidfuzz import process
+
+class SearchIndex:
+    """
+    SearchIndex keeps pre-normalized titles and a trigram inverted index,
+    so a search only reranks the titles that share grams with the query.
+    """
+
+    def __init__(self, normalize, gram_size: int = 3, max_candidates: int = 500) -> None:
+        self.normalize = normalize
+        self.gram_size = gram_size
+        self.max_candidates = max_candidates
+        self.lock = threading.RLock()
+        self.titles = {}
+        self.grams = {}
+
+    def get_grams(self, text: str) -> set:
+        text = f" {text} "
+        # Word prefixes keep one and two letter type-ahead queries matching
+        grams = {text[i:i + 2] for i in range(len(text) - 2) if text[i] == " "}
+        if len(text) <= self.gram_size:
+            return grams | {text}
+        return grams | {text[i:i + self.gram_size] for i in range(len(text) - self.gram_size + 1)}
+
+    def load(self, titles: list[str]) -> None:
+        with self.lock:
+            self.titles, self.grams = {}, {}
+            for i in titles:
+                self.add(i)
+
+    def add(self, title: str) -> None:
+        with self.lock:
+            if title in self.titles:
+                return
+            normalized = self.normalize(title)
+            self.titles[title] = normalized
+            for g in self.get_grams(normalized):
+                self.grams.setdefault(g, set()).add(title)
+
+    def remove(self, title: str) -> None:
+        with self.lock:
+            normalized = self.titles.pop(title, None)
+            if normalized is None:
+                return
+            for g in self.get_grams(normalized):
+                posting = self.grams.get(g)
+                if posting is None:
+                    continue
+                posting.discard(title)
+                if not posting:
+                    del self.grams[g]
+
+    def candidates(self, query: str) -> list[str]:
+        # Rarest grams first. Once max_candidates titles are collected, the
+        # remaining (common) grams only add to the counts of those titles,
+        # so no posting list is walked past the cap.
+        postings = sorted(
+            (self.grams[g] for g in self.get_grams(query) if g in self.grams), key=len)
+        counts = Counter()
+        for posting in postings:
+            if len(posting) <= len(counts):
+                for title in posting:
+                    if title in counts:
+                        counts[title] += 1
+            else:
+                for title in counts:
+                    if title in posting:
+                        counts[title] += 1
+            room = self.max_candidates - len(counts)
+            if room <= 0:
+                continue
+            for title in posting:
+                if title not in counts:
+                    counts[title] = 1
+                    room -= 1
+                    if not room:
+                        break
+        return [i[0] for i in counts.most_common(self.max_candidates)]
+
+    def search(self, query: str, limit: int = 20, min_score: int = 40) -> list[str]:
+        query = self.normalize(query)
+        if not query:
+            return []
+        with self.lock:
+            choices = {i: self.titles[i] for i in self.candidates(query)}
+        if not choices:
+            return []
+        return [i[2] for i in process.extract(query, choices, limit=limit) if i[1] > min_score]
@@ -0,0 +1,52 @@
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from index.log import LOG
+
+# Applied to every new SQLite connection. WAL lets readers run while the
+# indexer writes, NORMAL sync is safe under WAL and skips most fsyncs.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+
+def create_sqlite_engine(path: str):
+    engine = create_engine('sqlite:///' + path)
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(conn, _):
+        cursor = conn.cursor()
+        for i in PRAGMAS:
+            cursor.execute(f"PRAGMA {i}={PRAGMAS[i]}")
+        cursor.close()
+
+    return engine
+
+def add_columns(engine, table: str, columns: dict) -> list[str]:
+    existing = [i["name"] for i in inspect(engine).get_columns(table)]
+    missing = [i for i in columns if i not in existing]
+    if missing:
+        with engine.begin() as conn:
+            for i in missing:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {i} {columns[i]}"))
+    return missing
+
+def remove_duplicates(engine, table: str, columns: list[str]):
+    # Keeps the oldest row, which is the one lookups with .first() have been updating
+    group = ", ".join(columns)
+    with engine.begin() as conn:
+        res = conn.execute(text(
+            f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {group})"))
+        if res.rowcount:
+            LOG.log(f"Removed {res.rowcount} duplicate rows from {table}.")
+
+def create_indexes(engine, metadata):
+    for table in metadata.sorted_tables:
+        for i in table.indexes:
+            try:
+                i.create(engine, checkfirst=True)
+            except (IntegrityError, OperationalError) as e:
+                LOG.log(f"Could not create index {i.name}: {e}")
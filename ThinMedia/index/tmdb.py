@@ -1,114 +1,230 @@
-import requests
+import asyncio
 import threading
-import time
 import re
-import multiprocessing
 import os
+from concurrent.futures import Future
 from index.log import LOG
+from index.workers import Workers
+from index.client import Client, AsyncClient, aiohttp
+from index.ratelimit import RateLimiter, TokenBucket
+from index.cache import ResponseCache
+from urllib.parse import urlencode
 from PIL import Image
 from io import BytesIO
 from index.base import DB
 from dateutil.parser import parse
+import hp
 
 class TMDB:
-    def __init__(self, api_key: str, img_s: int, use_episode_img: bool) -> None:
+    def __init__(self, api_key: str, img_s: int, use_episode_img: bool, 
+            io_workers: int = 8, cpu_workers: int = 2, cache_ttl: dict = {}, cache_size: int = 20000,
+            img_format: str = "jpg", img_quality: int = 85, img_widths: list = [],
+            api_rate: float = 30, img_rate: float = 50, async_pool: int = 100) -> None:
         self.use_episode_img = use_episode_img
         self.api_valid = False
         self.api_key = api_key
-        self.max_tokens = 30
         self.img_s = img_s
-        self.tokens = self.max_tokens
-        self.lock = threading.Lock()
-        self.lock_condition = threading.Condition(self.lock)
+        self.img_format = img_format
+        self.img_quality = img_quality
+        # Smaller copies written next to every image for responsive srcsets
+        self.img_widths = sorted(img_widths)
+        # Widths TMDB serves for each image kind, besides the original
+        self.img_sizes = {"backdrop": [300, 780, 1280], "still": [92, 185, 300]}
         self.base = "https://api.themoviedb.org/3/"
-        threading.Thread(target=self.token_limiter, daemon=True).start()
-
-    def token_limiter(self):
-        while True:
-            with self.lock:
-                self.tokens = self.max_tokens
-                self.lock_condition.notify_all()
-            time.sleep(1)
-
-    def consume_token(self, size):
-        with self.lock:
-            while self.tokens < size:
-                self.lock_condition.wait()
-            self.tokens -= size
-
-    def run_tasks(self, func, args: list):
-        num_cpus = multiprocessing.cpu_count() 
-        tasks = []
-        for i in args:
-            f = threading.Thread(target=func, args=tuple(i))
-            f.start()
-            tasks.append(f)
-            if len(tasks) >= num_cpus:
-                for t in tasks: t.join()
-                tasks = []
-        if tasks:
-            for t in tasks: t.join()
+        self.img_base = "https://image.tmdb.org/t/p/"
+        # Shared by every title being indexed, so concurrency stays bounded globally
+        self.workers = Workers(io_workers, cpu_workers)
+        # Requests per second allowed for the API and the image CDN, kept apart
+        self.limiter = RateLimiter(
+            {"image.tmdb.org": TokenBucket("image", img_rate)}, TokenBucket("api", api_rate))
+        self.client = Client(self.limiter, pool_size=io_workers)
+        # Every TMDB fetch runs as a coroutine on this loop, the sync methods wait on it
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.aclient = AsyncClient(self.client, async_pool) if aiohttp else None
+        LOG.verbose(f"TMDB requests use {'aiohttp' if self.aclient else 'requests on the io stage'}.")
+        self.cache = ResponseCache(cache_size)
+        # Seconds a cached response stays valid, per endpoint
+        self.cache_ttl = {"search": 86400, "movie": 604800, "tv": 86400, "season": 86400}
+        self.cache_ttl.update(cache_ttl)
+
+    def get_image_size(self, kind: str, s: int) -> str:
+        # Images are resized to height s, TMDB buckets are widths of ~16:9 images
+        width = s * 16 / 9
+        for i in self.img_sizes[kind]:
+            if i >= width:
+                return f"w{i}"
+        return "original"
 
     def _process_image(self, img_data: bytes, s: int) -> Image:
         img = Image.open(BytesIO(img_data))
         width, height = img.size
         new_width = int(s * width / height)
-        return img.resize((new_width, s))
-        
-    def download_image(self, link, save_path, s):
-        if not link or link == "None": 
-            LOG.verbose(f"Image link is None: {link}")
-            return 1
-        
-        url = f"https://image.tmdb.org/t/p/original{link}"
-        self.consume_token(1)
+        # Lets the JPEG decoder downscale while decoding
+        img.draft("RGB", (new_width, s))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if img.size == (new_width, s):
+            return img
+        return img.resize((new_width, s), Image.LANCZOS, reducing_gap=2.0)
+
+    def get_image_source(self, link, s) -> str:
+        return f"{link}|{s}|{self.img_format}|{self.img_quality}|{self.img_widths}"
+
+    def write_image(self, img: Image, save_path):
+        if self.img_format == "webp":
+            img.save(save_path, "WEBP", quality=self.img_quality, method=4)
+        else:
+            img.save(save_path, "JPEG", quality=self.img_quality, optimize=True, progressive=True)
+
+    def is_image_cached(self, link, save_path, s) -> bool:
+        try:
+            with open(f"{save_path}.src", "r") as f:
+                return os.path.exists(save_path) and f.read() == self.get_image_source(link, s)
+        except OSError:
+            return False
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
 
-        response = requests.get(url)
-        if response.status_code != 200:
+    def submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def request(self, url: str, headers: dict = {}):
+        if self.aclient:
+            return await self.aclient.get(url, headers)
+        # Without aiohttp the blocking client runs on the io stage
+        return await asyncio.wrap_future(self.workers.io.submit(self.client.get, url, headers))
+
+    async def fetch_image(self, link, size: str = "original"):
+        url = f"{self.img_base}{size}{link}"
+        response = await self.request(url)
+        if response is None or response.status_code != 200:
             LOG.verbose(f"Image download failed: {url}")
+            return None
+        return response.content
+
+    def save_image(self, content, link, save_path, s):
+        if content is None:
             return 1
 
-        img = self._process_image(response.content, s)
-        img.save(save_path)  
+        img = self._process_image(content, s)
+        self.write_image(img, save_path)
+
+        width, height = img.size
+        for i in self.img_widths:
+            if i >= width:
+                break
+            self.write_image(
+                img.resize((i, int(height * i / width)), Image.LANCZOS, reducing_gap=2.0),
+                hp.variant_path(save_path, i))
+
+        with open(f"{save_path}.src", "w") as f:
+            f.write(self.get_image_source(link, s))
             
         LOG.verbose(f"Image saved: {save_path}")
 
         return 0
-    
+
+    async def save_image_async(self, link, save_path, s, kind: str = "backdrop") -> int:
+        if not link or link == "None": 
+            LOG.verbose(f"Image link is None: {link}")
+            return 1
+
+        if self.is_image_cached(link, save_path, s):
+            LOG.verbose(f"Image unchanged: {save_path}")
+            return 0
+
+        content = await self.fetch_image(link, self.get_image_size(kind, s))
+        return await asyncio.wrap_future(self.workers.cpu.submit(self.save_image, content, link, save_path, s))
+
     def get(self, url: str, headers: dict = {}):
-        self.consume_token(1)
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200: 
+        response = self.client.get(url, headers)
+        if response is not None and response.status_code == 200: 
             return response.json()
         return None
+
+    async def get_async(self, url: str, headers: dict = {}):
+        response = await self.request(url, headers)
+        if response is not None and response.status_code == 200: 
+            return response.json()
+        return None
+
+    def cache_key(self, path: str, params: dict) -> str:
+        return f"{path}?{urlencode(sorted(params.items()))}"
+
+    def api_url(self, path: str, params: dict) -> str:
+        return f"{self.base}{path}?{urlencode(dict(params, api_key=self.api_key))}"
     
+    def get_cached(self, endpoint: str, path: str, params: dict = {}):
+        key = self.cache_key(path, params)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+
+        data = self.get(self.api_url(path, params), {"accept": "application/json"})
+        if data is not None:
+            self.cache.put(key, data, self.cache_ttl[endpoint])
+        return data
+
+    async def get_cached_async(self, endpoint: str, path: str, params: dict = {}):
+        key = self.cache_key(path, params)
+        data = await asyncio.to_thread(self.cache.get, key)
+        if data is not None:
+            return data
+
+        data = await self.get_async(self.api_url(path, params), {"accept": "application/json"})
+        if data is not None:
+            await asyncio.to_thread(self.cache.put, key, data, self.cache_ttl[endpoint])
+        return data
+
     def search(self, name):
-        url = f"{self.base}search/multi?include_adult=true&page=1"
-        url += f"&query={name}&api_key={self.api_key}"
-        return self.get(url, {"accept": "application/json"})
+        return self.get_cached(
+            "search", "search/multi", {"include_adult": "true", "page": 1, "query": name})
 
     def get_movie_data(self, id):
-        return self.get(f"{self.base}movie/{id}?api_key={self.api_key}")
+        return self.get_cached("movie", f"movie/{id}")
     
     def get_tv_data(self, id):
-        return self.get(f"{self.base}tv/{id}?api_key={self.api_key}")
+        return self.get_cached("tv", f"tv/{id}")
 
     def get_season_data(self, id: str, season: int):
-        return self.get(f"{self.base}tv/{id}/season/{season}?api_key={self.api_key}")
+        return self.get_cached("season", f"tv/{id}/season/{season}")
+
+    async def get_movie_data_async(self, id):
+        return await self.get_cached_async("movie", f"movie/{id}")
+    
+    async def get_tv_data_async(self, id):
+        return await self.get_cached_async("tv", f"tv/{id}")
+
+    async def get_season_data_async(self, id: str, season: int):
+        return await self.get_cached_async("season", f"tv/{id}/season/{season}")
     
     def get_year(self, date):
         try: return parse(date).year
         except: return 0
 
-    def create_img_path(self, title, dir, img, img_type='jpg'):
+    def create_img_path(self, title, dir, img, img_type=None):
+        img_type = img_type or self.img_format
         dir_path = os.path.join(
             os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
             "data", "img", title, dir)
         os.makedirs(dir_path, exist_ok=True)
         return os.path.join(dir_path, f"{img}.{img_type}")
 
+    async def wait_images(self, tasks: list):
+        for i in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(i, Exception):
+                LOG.verbose(f"Image task failed: {i}")
+
     def create_movie_data(self, id):
-        base = self.get_movie_data(id)
+        return self.run(self.create_movie_data_async(id))
+
+    def create_tv_data(self, id):
+        return self.run(self.create_tv_data_async(id))
+
+    async def create_movie_data_async(self, id):
+        base = await self.get_movie_data_async(id)
         if not base: 
             return None
 
@@ -130,16 +246,17 @@ class TMDB:
         base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         if base["backdrop_path"] and base["backdrop_path"] != "None":
             img_path = self.create_img_path(media['clean_title'], 'base', 'base')
-            self.download_image(base["backdrop_path"], img_path, self.img_s)
+            await self.save_image_async(base["backdrop_path"], img_path, self.img_s)
             img = DB.create_base_img_dict(base=img_path.replace(base_dir, ""), header=None)        
             img['seasons'] = {0: {0: img_path.replace(base_dir, "")}}
         else:
+            img = DB.create_base_img_dict(base="", header=None)
             img['seasons'] = {0: {0: ""}}
 
         return media, seasons, img
 
-    def create_tv_data(self, id):
-        base = self.get_tv_data(id)
+    async def create_tv_data_async(self, id):
+        base = await self.get_tv_data_async(id)
         if not base: 
             return None
         
@@ -153,24 +270,22 @@ class TMDB:
             media_type = "tv")
         
         base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        tasks = []
         if base["backdrop_path"] and base["backdrop_path"] != "None":
             img_path = self.create_img_path(media['clean_title'], 'base', 'base')
-            self.download_image(base["backdrop_path"], img_path, self.img_s)
+            tasks.append(asyncio.create_task(self.save_image_async(base["backdrop_path"], img_path, self.img_s)))
             img = DB.create_base_img_dict(base=img_path.replace(base_dir, ""), header=None)     
         else:
             img = DB.create_base_img_dict(base="", header=None)     
 
         img["seasons"] = {}
-        
-        seasons, tasks = {}, []
-        for i in base['seasons']:
-            season_number = i['season_number']
-            img['seasons'][season_number] = {}
-                
-            seasons[season_number] = {}
-            season_data = self.get_season_data(id, season_number)
+        seasons = {}
+
+        # Episode images are queued as soon as their season arrives
+        async def load_season(season_number: int):
+            season_data = await self.get_season_data_async(id, season_number)
             if not season_data: 
-                continue
+                return
             
             for ep in season_data['episodes']:
                 ep_number = ep['episode_number']
@@ -181,18 +296,24 @@ class TMDB:
                 if ep['still_path'] and ep['still_path'] != "None" and self.use_episode_img:
                     img_path = self.create_img_path(
                         media['clean_title'], f"S{season_number}E{ep_number}", "base")
-                    tasks.append([ep['still_path'], img_path, self.img_s])
+                    tasks.append(asyncio.create_task(
+                        self.save_image_async(ep['still_path'], img_path, self.img_s, "still")))
                     img['seasons'][season_number][ep_number] = img_path.replace(base_dir, "")
                 else:
                     img['seasons'][season_number][ep_number] = ""
 
+        for i in base['seasons']:
+            img['seasons'][i['season_number']] = {}
+            seasons[i['season_number']] = {}
+        await asyncio.gather(*[load_season(i['season_number']) for i in base['seasons']])
+
         if tasks:
-            self.run_tasks(self.download_image, tasks)
+            await self.wait_images(tasks)
 
         return media, seasons, img
             
     def check_api_key(self):
-        req = self.get("https://api.themoviedb.org/3/authentication?api_key="+self.api_key)
+        req = self.get(f"{self.base}authentication?api_key={self.api_key}")
         if req:
             if req["success"]: 
                 self.api_valid = True
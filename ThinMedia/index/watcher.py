@@ -0,0 +1,183 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from index.log import LOG
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT = struct.Struct("iIII")
+
+NETWORK_FS = ["nfs", "nfs4", "cifs", "smbfs", "smb3", "9p", "fuse.sshfs", "fuse.rclone", "afs"]
+
+class Inotify:
+    """
+    Inotify is a minimal ctypes binding that watches every directory of a tree.
+    """
+
+    def __init__(self) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.wds = {}
+
+    def add(self, path: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {path}")
+        self.wds[wd] = path
+
+    def add_tree(self, path: str):
+        self.add(path)
+        for folder_name, dirs, _ in os.walk(path):
+            for i in dirs:
+                self.add(os.path.join(folder_name, i))
+
+    def read(self, timeout: float) -> list[tuple]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 65536)
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    """
+    Watcher follows the library folders and reports changed directories
+    once they have been quiet for the debounce period. It uses inotify
+    where possible and falls back to polling directory mtimes, which
+    also covers network mounts where inotify never fires.
+    """
+
+    def __init__(self, paths: list[str], on_change, mode: str = "auto",
+            debounce: float = 5, poll_interval: float = 60) -> None:
+        self.paths = paths
+        self.on_change = on_change
+        self.mode = mode
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+
+    def start(self):
+        for i in self.paths:
+            threading.Thread(target=self.run, args=(i,), daemon=True).start()
+
+    def is_network_fs(self, path: str) -> bool:
+        try:
+            with open("/proc/mounts", "r") as f:
+                mounts = [i.split()[:3] for i in f]
+        except OSError:
+            return False
+
+        path = os.path.realpath(path)
+        best, fs_type = "", ""
+        for _, mount, fs in mounts:
+            if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) > len(best):
+                best, fs_type = mount, fs
+        return fs_type in NETWORK_FS
+
+    def notify(self, changed: set, overflow: bool = False):
+        try:
+            self.on_change(changed, overflow)
+        except Exception as e:
+            LOG.log(f"Watcher failed to apply changes: {e}")
+
+    def run(self, path: str):
+        if self.mode == "poll" or (self.mode == "auto" and self.is_network_fs(path)):
+            return self.poll(path)
+        try:
+            inotify = Inotify()
+            inotify.add_tree(path)
+        except (OSError, AttributeError) as e:
+            LOG.log(f"Inotify unavailable for {path} ({e}), polling instead.")
+            return self.poll(path)
+        LOG.verbose(f"Watching with inotify: {path}")
+        self.watch(path, inotify)
+
+    def watch(self, path: str, inotify: Inotify):
+        pending, last_event, overflow = set(), 0, False
+        while True:
+            for wd, mask, name in inotify.read(1):
+                if mask & IN_Q_OVERFLOW:
+                    # Events were dropped, new folders may be unwatched as well
+                    LOG.log(f"Inotify queue overflowed, rescanning: {path}")
+                    try:
+                        inotify.add_tree(path)
+                    except OSError as e:
+                        LOG.verbose(f"Could not rewatch {path}: {e}")
+                    pending.add(path)
+                    last_event, overflow = time.time(), True
+                    continue
+                if mask & IN_IGNORED:
+                    inotify.wds.pop(wd, None)
+                    continue
+
+                folder = inotify.wds.get(wd)
+                if folder is None:
+                    continue
+                pending.add(folder)
+                last_event = time.time()
+
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    new_dir = os.path.join(folder, name)
+                    pending.add(new_dir)
+                    try:
+                        inotify.add_tree(new_dir)
+                    except OSError as e:
+                        LOG.verbose(f"Could not watch {new_dir}: {e}")
+
+            if pending and time.time() - last_event >= self.debounce:
+                changed, pending = pending, set()
+                self.notify(changed, overflow)
+                overflow = False
+
+    def snapshot(self, path: str) -> dict:
+        dirs, stack = {}, [path]
+        while stack:
+            folder = stack.pop()
+            try:
+                dirs[folder] = os.stat(folder).st_mtime
+                with os.scandir(folder) as entries:
+                    stack.extend(i.path for i in entries if i.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+        return dirs
+
+    def poll(self, path: str):
+        LOG.verbose(f"Watching by polling: {path}")
+        last = self.snapshot(path)
+        while True:
+            time.sleep(self.poll_interval)
+            current = self.snapshot(path)
+            changed = {i for i in current if last.get(i) != current[i]}
+            changed |= {i for i in last if i not in current}
+            last = current
+            if changed:
+                self.notify(changed)
@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from index.log import LOG
+
+class Stage:
+    """
+    Stage is a long lived pool of worker threads fed from a work queue.
+    It keeps counters so queue depth and throughput can be reported.
+    """
+
+    def __init__(self, name: str, workers: int, window: int = 60) -> None:
+        self.name = name
+        self.workers = max(1, workers)
+        self.window = window
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        self.completed = deque()
+        for _ in range(self.workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def submit(self, func, *args) -> Future:
+        future = Future()
+        self.queue.put((future, func, args))
+        return future
+
+    def worker(self):
+        while True:
+            future, func, args = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            with self.lock:
+                self.active += 1
+
+            failed = False
+            try:
+                result = func(*args)
+            except Exception as e:
+                failed = True
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+            with self.lock:
+                self.active -= 1
+                self.done += 1
+                self.failed += failed
+                self.completed.append(time.time())
+
+    def stats(self) -> dict:
+        with self.lock:
+            now = time.time()
+            while self.completed and now - self.completed[0] > self.window:
+                self.completed.popleft()
+            return {
+                "name": self.name,
+                "workers": self.workers,
+                "queued": self.queue.qsize(),
+                "active": self.active,
+                "done": self.done,
+                "failed": self.failed,
+                "throughput": round(len(self.completed) / self.window, 2)
+            }
+
+class Workers:
+    """
+    Workers holds the indexer stages: network fetches run on the io stage
+    and image resize/encode runs on the cpu stage.
+    """
+
+    def __init__(self, io_workers: int, cpu_workers: int) -> None:
+        self.io = Stage("io", io_workers)
+        self.cpu = Stage("cpu", cpu_workers)
+
+    def stats(self) -> list[dict]:
+        return [self.io.stats(), self.cpu.stats()]
+
+    def log_stats(self):
+        for i in self.stats():
+            LOG.verbose(
+                f"Stage {i['name']}: queued {i['queued']}, active {i['active']}/{i['workers']}, "
+                f"done {i['done']}, failed {i['failed']}, {i['throughput']}/s")
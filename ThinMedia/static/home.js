@@ -19,8 +19,9 @@ function load_media() {
 }
 
 function load_unique_genres() {
-  const url = "/unique-genres-html";
-  fetchText(url).then((data) => {
+  var search = document.getElementById("search").value;
+  const url = "/unique-genres-html?search=";
+  fetchText(url + search).then((data) => {
     var media_div = document.getElementById("unique_genres");
     media_div.innerHTML = data;
   });
@@ -49,6 +50,7 @@ function media_search(input) {
     var media_div = document.getElementById("media");
     media_div.innerHTML = data;
   });
+  load_unique_genres();
 }
 
 function clear_all_selected_genres() {
@@ -1,5 +1,8 @@
-from sqlalchemy import create_engine, Column, Integer, String, JSON, Boolean
+from sqlalchemy import Column, Integer, String, JSON, Boolean, Index
 from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
+from index.storage import create_sqlite_engine, create_indexes, remove_duplicates
+from index.log import LOG
+from index.lru import LRUCache
 from hashlib import sha512
 import random
 import string
@@ -7,6 +10,9 @@ import uuid
 import os
 import json
 import time
+import threading
+import atexit
+import signal
 
 UserBase = declarative_base()
 WatchBase = declarative_base()
@@ -23,13 +29,16 @@ class WatchInfo(WatchBase):
     watched = Column(Boolean, nullable=False)
     playback = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        Index("ix_watch_info_key", "username", "title", "season", "episode", unique=True),)
+
 class UserData(UserBase):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, index=True)
     password = Column(String, nullable=False)
-    api = Column(String, nullable=False)
+    api = Column(String, nullable=False, unique=True, index=True)
     role = Column(String, nullable=False)
 
     mapped = Column(JSON, nullable=False)
@@ -37,11 +46,12 @@ class UserData(UserBase):
 class Users:
     def __init__(self) -> None:
         self.base_dir = os.path.dirname(os.path.abspath(__file__))
-        self.engine = create_engine(
-            'sqlite:///' + os.path.join(self.base_dir, 'data', 'users.db'))
+        self.engine = create_sqlite_engine(os.path.join(self.base_dir, 'data', 'users.db'))
         UserBase.metadata.create_all(self.engine)
+        create_indexes(self.engine, UserBase.metadata)
         self.maker = sessionmaker(bind=self.engine)
         self.sco = scoped_session(self.maker)
+        self.api_cache = LRUCache(max_size=256, ttl=300)
 
     def to_json(self, n: dict):
         return json.loads(json.dumps(n))
@@ -52,6 +62,13 @@ class Users:
             user.mapped = data
             session.commit()
 
+    def add_mapped(self, name: str, path: str, match) -> None:
+        # Read and write in one session so a concurrent clear is not overwritten
+        with self.sco() as session:
+            user = session.query(UserData).filter(UserData.name == name).first()
+            user.mapped = dict(user.mapped, **{path: match})
+            session.commit()
+
     def get_mapped(self, name: str) -> dict:
         with self.sco() as session:
             user = session.query(UserData).filter(UserData.name == name).first()
@@ -84,11 +101,16 @@ class Users:
             return {'user': user.name, 'password': user.password, 'api': user.api, 'role': user.role}
 
     def get_json_api(self, api: str):
+        user = self.api_cache.get(api)
+        if user is not None:
+            return user
         with self.sco() as session:
             user = session.query(UserData).filter(UserData.api == api).first()
             if not user: 
                 return None
-            return {'user': user.name, 'password': user.password, 'api': user.api, 'role': user.role}
+            user = {'user': user.name, 'password': user.password, 'api': user.api, 'role': user.role}
+        self.api_cache.put(api, user)
+        return user
 
     def get_all(self):
         with self.sco() as session:
@@ -114,6 +136,7 @@ class Users:
     def change_api(self, name) -> None:
         with self.sco() as session:
             data = session.query(UserData).filter(UserData.name == name).first()
+            self.api_cache.pop(data.api)
             data.api = self.create_api_key()
             session.commit()
 
@@ -124,41 +147,127 @@ class Users:
 class WatchInfoManager:
     def __init__(self) -> None:
         self.base_dir = os.path.dirname(os.path.abspath(__file__))
-        self.engine = create_engine(
-            'sqlite:///' + os.path.join(self.base_dir, 'data', 'watch_info.db'))
+        self.engine = create_sqlite_engine(os.path.join(self.base_dir, 'data', 'watch_info.db'))
         WatchBase.metadata.create_all(self.engine)
+        remove_duplicates(self.engine, "watch_info", ["username", "title", "season", "episode"])
+        create_indexes(self.engine, WatchBase.metadata)
         self.maker = sessionmaker(bind=self.engine)
         self.sco = scoped_session(self.maker)
+
+        # Write-behind buffer of changed fields per (username, title, season, episode)
+        # Entries stay here until their commit succeeds so reads always see them
+        self.pending = {}
+        self.pending_lock = threading.RLock()
+        self.flush_lock = threading.RLock()
+        self.flush_interval = 5
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+        atexit.register(self.flush)
+
+        # atexit does not run on SIGTERM, flush there and hand over to the old handler
+        self.previous_sigterm = None
+        if threading.current_thread() is threading.main_thread():
+            self.previous_sigterm = signal.signal(signal.SIGTERM, self.on_sigterm)
+
+    def on_sigterm(self, signum, frame):
+        try:
+            self.flush()
+        except Exception as e:
+            LOG.log(f"Failed to flush watch info on shutdown: {e}")
+
+        if callable(self.previous_sigterm):
+            self.previous_sigterm(signum, frame)
+        elif self.previous_sigterm != signal.SIG_IGN:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                LOG.log(f"Failed to flush watch info: {e}")
+
+    def buffer(self, username: str, title: str, season: int, episode: int, **fields):
+        with self.pending_lock:
+            self.pending.setdefault((username, title, season, episode), {}).update(fields)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.pending_lock:
+                pending = {i: dict(self.pending[i]) for i in self.pending}
+            if not pending:
+                return
+
+            with self.sco() as session:
+                for key in pending:
+                    info = self.get_or_create(session, *key)
+                    for field in pending[key]:
+                        setattr(info, field, pending[key][field])
+                session.commit()
+
+            # Anything buffered since the snapshot is newer and waits for the next flush
+            with self.pending_lock:
+                for key in pending:
+                    if self.pending.get(key) == pending[key]:
+                        del self.pending[key]
+
+    def get_pending(self, username: str, title: str, season: int, episode: int) -> dict:
+        with self.pending_lock:
+            return dict(self.pending.get((username, title, season, episode), {}))
     
     def search_watch_info(self, username: str, title: str, season: int, episode: int) -> WatchInfo:
         with self.sco() as session:
-            return session.query(WatchInfo).filter(
-                WatchInfo.username == username,
-                WatchInfo.title == title,
-                WatchInfo.season == season,
-                WatchInfo.episode == episode
-            ).first()
+            return self.query_watch_info(session, username, title, season, episode)
+
+    def query_watch_info(self, session, username: str, title: str, season: int, episode: int) -> WatchInfo:
+        return session.query(WatchInfo).filter(
+            WatchInfo.username == username,
+            WatchInfo.title == title,
+            WatchInfo.season == season,
+            WatchInfo.episode == episode
+        ).first()
+
+    def create_default(self, username: str, title: str, season: int, episode: int) -> WatchInfo:
+        return WatchInfo(
+            username = username, 
+            last_watched = 0,
+            title = title, 
+            season = season, 
+            episode = episode,
+            watched = False, 
+            playback = 0)
+
+    def get_or_create(self, session, username: str, title: str, season: int, episode: int) -> WatchInfo:
+        # Missing rows mean default watch info, they are only written once something changes
+        info = self.query_watch_info(session, username, title, season, episode)
+        if not info:
+            info = self.create_default(username, title, season, episode)
+            session.add(info)
+        return info
     
     def create_default_watch_info(self, username: str, title: str, season: int, episode: int) -> None:
         with self.sco() as session:
-            session.add(WatchInfo(
-                username = username, 
-                last_watched = 0,
-                title = title, 
-                season = season, 
-                episode = episode,
-                watched = False, 
-                playback = 0))
+            self.get_or_create(session, username, title, season, episode)
             session.commit()
 
     def init_media_history(self, username: str, episodes: dict, title: str):
-        for i in episodes:
-            for ep in episodes[i]:
-                self.create_default_watch_info(username, title, i, ep)
+        with self.sco() as session:
+            existing = {(i.season, i.episode) for i in session.query(
+                WatchInfo.season, WatchInfo.episode).filter(
+                WatchInfo.username == username, WatchInfo.title == title).all()}
+            session.add_all([
+                self.create_default(username, title, int(i), int(ep))
+                for i in episodes for ep in episodes[i] if (int(i), int(ep)) not in existing])
+            session.commit()
 
     def get_watch_info_in_dict(self, username: str, title: str, season: int, episode: int) -> dict:
+        # Buffer first, a flush landing before the query is then in the row instead
+        pending = self.get_pending(username, title, season, episode)
         info = self.search_watch_info(username, title, season, episode)
-        return {
+        if not info:
+            info = self.create_default(username, title, season, episode)
+        return dict({
             "id": info.id, 
             "username": info.username, 
             "last_watched": info.last_watched, 
@@ -167,34 +276,24 @@ class WatchInfoManager:
             "episode": info.episode, 
             "watched": info.watched, 
             "playback": info.playback
-        }
+        }, **pending)
     
     def set_watched(self, username: str, title: str, season: int, episode: int, watched: int) -> None:
-        with self.sco() as session:
-            info = session.query(WatchInfo).filter(
-                WatchInfo.username == username,
-                WatchInfo.title == title,
-                WatchInfo.season == season,
-                WatchInfo.episode == episode).first()
-
-            if watched in [1, 2]:
-                info.watched = True
-                if watched == 2:
-                    info.last_watched = time.time()
+        if watched in [1, 2]:
+            if watched == 2:
+                self.buffer(username, title, season, episode, watched=True, last_watched=time.time())
             else:
-                info.watched = False 
-           
-            session.commit()
+                self.buffer(username, title, season, episode, watched=True)
+        else:
+            self.buffer(username, title, season, episode, watched=False)
 
     def rotate_watched(self, username: str, title: str, season: int, episode: int) -> None:
-        with self.sco() as session:
-            info = session.query(WatchInfo).filter(
-                WatchInfo.username == username,
-                WatchInfo.title == title,
-                WatchInfo.season == season,
-                WatchInfo.episode == episode).first()
-            info.watched = not info.watched
-            session.commit()
+        # No flush may land between reading the row and the buffer
+        with self.flush_lock:
+            info = self.search_watch_info(username, title, season, episode)
+            with self.pending_lock:
+                fields = self.pending.setdefault((username, title, season, episode), {})
+                fields["watched"] = not fields.get("watched", info.watched if info else False)
 
     def get_all_user_title_history(self, username: str, title: str):
         with self.sco() as session:
@@ -202,54 +301,40 @@ class WatchInfoManager:
                 WatchInfo.username == username, WatchInfo.title == title).all()
 
     def get_all_title_history(self, username: str, title: str, episodes: dict) -> dict:
-        all_info = self.get_all_user_title_history(username, title)
-        if not all_info: 
-            self.init_media_history(username, episodes, title)
-            all_info = self.get_all_user_title_history(username, title)
+        # Buffer first, a flush landing before the query is then in the rows instead
+        with self.pending_lock:
+            pending = {
+                k: dict(self.pending[k]) for k in self.pending if k[0] == username and k[1] == title}
 
         info = {}
-        for i in all_info:
+        for i in episodes:
+            info[int(i)] = {
+                int(ep): {"watched": False, "playback": 0, "last_watched": 0} for ep in episodes[i]}
+
+        for i in self.get_all_user_title_history(username, title):
             if i.season not in info: info[i.season] = {}
             info[i.season][i.episode] = {
                 "watched": i.watched, "playback": i.playback, "last_watched": i.last_watched
             }
 
+        for (_, _, season, episode), fields in pending.items():
+            if season not in info: info[season] = {}
+            if episode not in info[season]:
+                info[season][episode] = {"watched": False, "playback": 0, "last_watched": 0}
+            info[season][episode].update(fields)
+
         return info
 
     def get_all_title_history_str_key(self, username: str, title: str, episodes: dict) -> dict:
-        all_info = self.get_all_user_title_history(username, title)
-        if not all_info: 
-            self.init_media_history(username, episodes, title)
-            all_info = self.get_all_user_title_history(username, title)
-
-        info = {}
-        for i in all_info:
-            season = str(i.season)
-
-            if season not in info: 
-                info[season] = {}
-
-            info[season][str(i.episode)] = {
-                "watched": i.watched, "playback": i.playback, "last_watched": i.last_watched
-            }
-
-        return info
+        all_info = self.get_all_title_history(username, title, episodes)
+        return {
+            str(i): {str(ep): all_info[i][ep] for ep in all_info[i]} for i in all_info}
     
     def set_playback(self, username: str, title: str, season: int, episode: int, playback: int) -> None:
-        with self.sco() as session:
-            info = session.query(WatchInfo).filter(
-                WatchInfo.username == username,
-                WatchInfo.title == title,
-                WatchInfo.season == season,
-                WatchInfo.episode == episode).first()
-            info.playback = playback
-            session.commit()
+        self.buffer(username, title, season, episode, playback=playback)
 
     def set_last_watched(self, username: str, title: str, season: int, episode: int, last_watched: int) -> None:
-        with self.sco() as session:
-            info = self.search_watch_info(username, title, season, episode)
-            info.last_watched = last_watched
-            session.commit()
+        self.buffer(username, title, season, episode, last_watched=last_watched)
 
 user_manager = Users()
 